@@ -4,12 +4,14 @@ from enum import Enum, IntEnum, StrEnum
 # Constants
 ALLOWED_RUS_SYMBOLS = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя -'
 TIME_ZONE = 'Europe/Moscow'
+EXCERPT_LENGTH = 150
 
 # Paths
 basedir = os.path.abspath(os.path.dirname(__file__))
 CSV_FILE_PATH = os.path.join(basedir, 'csv', 'roles.csv')
 FILE_BASE_PATH = os.path.join(basedir, 'mct_app', 'files')
 FILE_REL_PATH = os.path.join('..', '..', '..', 'files')
+STAGING_PATH = os.path.join(FILE_BASE_PATH, 'staging')
 LOGS_DIR_PATH = os.path.join(basedir, 'logs')
 BANNED_IP_FILE_PATH = os.path.join(basedir, 'banned_ip', 'banned_ip.json')
 
@@ -43,6 +45,13 @@ class Mood(Enum):
     DISAPPOINTED = '😞Разочарованный😞'
 
 
+class ContentType(StrEnum):
+    """Class of content types which progress of reading is tracked."""
+
+    ARTICLE = 'article'
+    TEXTBOOK_PARAGRAPH = 'textbook_paragraph'
+
+
 class SocialPlatform(StrEnum):
     """Class for choosing social platform registering from."""
 
@@ -70,6 +79,7 @@ class Config:
 
     # Banned IP path
     BANNED_IP_PATH = BANNED_IP_FILE_PATH
+    BANNED_IP_CHECK_INTERVAL = 1
 
     # Mail
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -84,6 +94,11 @@ class Config:
 
     # Uploads
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    IMAGE_WIDTHS = (320, 640, 1280)
+    FILES_MAX_AGE = 31_536_000
+    # internal location of the front proxy serving uploaded files
+    FILES_ACCEL_REDIRECT = os.environ.get('FILES_ACCEL_REDIRECT')
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == 'True'
 
     # Ckeditor
     CKEDITOR_SERVE_LOCAL = True
@@ -100,6 +115,12 @@ class Config:
 
     # Elasticsearch setup
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
+    SEARCH_BULK_CHUNK_SIZE = 500
+    SEARCH_CACHE_TIMEOUT = 60
+    SEARCH_FLUSH_DELAY = 2
+    SEARCH_MAX_RETRIES = 5
+    SEARCH_RETRY_DELAY = 10
 
     # Logging Setup
     LOG_TYPE = 'file'
@@ -117,6 +138,12 @@ class Config:
     CACHE_IGNORE_ERRORS = False
     CACHE_REDIS_URL = os.environ.get('REDIS_URL')
 
+    # Logged in user snapshots
+    PRINCIPAL_CACHE = False
+    PRINCIPAL_CACHE_TTL = 60
+    PRINCIPAL_LOCAL_TTL = 5
+    PRINCIPAL_LRU_SIZE = 1024
+
 
 class ProductionConfig(Config):
     """Class for app config on a real server in production."""
@@ -134,6 +161,7 @@ class ProductionConfig(Config):
 
     # Caching
     CACHE_IGNORE_ERRORS = True
+    PRINCIPAL_CACHE = True
 
 
 class DevelopmentConfig(Config):
@@ -5,7 +5,8 @@ from flask_migrate import Migrate
 from mct_app import create_app, db
 from config import CSV_FILE_PATH
 from mct_app.auth.models import Role, User, UserRole
-from mct_app.site.models import Article, Image, News, TextbookParagraph
+from mct_app.site.models import (Article, ContentCounter, Image,
+                                 News, TextbookParagraph)
 
 
 app = create_app()
@@ -21,6 +22,8 @@ def make_shell_context() -> dict[str, Any]:
             'db': db,
             'general_setup': general_setup,
             'recreate_db': recreate_db,
+            'recompute_counters': recompute_counters,
+            'recreate_search_indexes': recreate_search_indexes,
             'User': User,
             'Image': Image,
             'news': News,
@@ -35,9 +38,27 @@ def recreate_db() -> None:
     db.session.commit()
 
 
-def recreate_search_indexes() -> None:
+@app.cli.command('reindex')
+def reindex_command() -> None:
+    """Rebuild search indexes and switch their aliases."""
+    print(f'textbook_paragraph: {recreate_search_indexes()}')
+
+
+def recreate_search_indexes() -> str | None:
     """Recreate indexes of textbook paragraphs in Elasticsearch."""
-    TextbookParagraph.reindex()
+    return TextbookParagraph.reindex()
+
+
+@app.cli.command('recompute-counters')
+def recompute_counters_command() -> None:
+    """Recompute amounts of rows shown by paginated feeds."""
+    for name, value in sorted(recompute_counters().items()):
+        print(f'{name}: {value}')
+
+
+def recompute_counters() -> dict[str, int]:
+    """Count news, articles, questions and diary records again."""
+    return ContentCounter.recompute()
 
 
 def general_setup() -> None:
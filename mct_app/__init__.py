@@ -1,6 +1,5 @@
 from datetime import datetime
 import re
-import json
 import logging
 import os
 
@@ -12,7 +11,7 @@ from flask_admin import Admin
 from flask_caching import Cache
 from flask_ckeditor import CKEditor
 from flask_debugtoolbar import DebugToolbarExtension
-from flask_login import LoginManager
+from flask_login import current_user, LoginManager
 from flask_mailman import Mail
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
@@ -21,6 +20,7 @@ from sqlalchemy import MetaData
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from mct_app.blacklist import IPBlacklist
 from mct_app.flask_log import LogSetup
 
 load_dotenv()
@@ -46,6 +46,7 @@ ckeditor = CKEditor()
 csrf = CSRFProtect()
 toolbar = DebugToolbarExtension()
 cache = Cache()
+blacklist = IPBlacklist()
 
 
 def create_app(mode=os.environ.get('APP_DEV_MODE')) -> Flask:
@@ -96,23 +97,22 @@ def create_app(mode=os.environ.get('APP_DEV_MODE')) -> Flask:
     celery_init_app(app)
     LogSetup().init_app(app)
     cache.init_app(app)
+    blacklist.init_app(app)
 
     # create database
     with app.app_context():
         db.create_all()
 
     # check whether visitor is banned
+    from mct_app.caching import invalidate_user_namespace
+
     @app.before_request
     def check_ip_in_blacklist() -> None:
-        current_ip = request.remote_addr
-        banned_ip_path = app.config.get('BANNED_IP_PATH')
-        if os.path.exists(banned_ip_path):
-            with open(banned_ip_path) as file:
-                blacklist = json.load(file)
-            if current_ip in blacklist:
-                cache.clear()
-                session.clear()
-                abort(403)
+        if blacklist.is_banned(request.remote_addr):
+            if current_user.is_authenticated:
+                invalidate_user_namespace(current_user.id)
+            session.clear()
+            abort(403)
 
     # register blueprints
     from mct_app.auth.views import auth
@@ -124,6 +124,10 @@ def create_app(mode=os.environ.get('APP_DEV_MODE')) -> Flask:
     from mct_app.administration.views import MyAdminIndexView
     admin.init_app(app, index_view=MyAdminIndexView())
 
+    # Jinja2 filters depending on models
+    from mct_app.utils import srcsetfilter
+    app.jinja_env.filters['srcsetfilter'] = srcsetfilter
+
     @app.after_request
     def after_request(response: Response) -> Response:
         """Do logging after every request."""
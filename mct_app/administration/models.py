@@ -9,4 +9,4 @@ class BannedIPs(db.Model):
     __tablename__ = 'banned_ips'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    banned_ip: Mapped[str] = mapped_column(String(15), nullable=False)
+    banned_ip: Mapped[str] = mapped_column(String(43), nullable=False)
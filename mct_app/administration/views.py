@@ -1,13 +1,13 @@
-import json
+import hashlib
+from io import BytesIO
+import mimetypes
 import os
 import os.path as op
-import uuid
+from urllib.parse import quote
 
 
-import elasticsearch
-import elastic_transport
-from flask import (abort, Blueprint,
-                   current_app, request,
+from flask import (abort, Blueprint, current_app,
+                   jsonify, request, send_file,
                    send_from_directory, url_for)
 import flask_admin
 from flask_admin import expose
@@ -16,30 +16,33 @@ from flask_admin.menu import MenuLink
 from flask_admin.form.upload import ImageUploadField
 from flask_ckeditor import CKEditorField, upload_fail, upload_success
 from flask_login import current_user
+import kombu
 from markupsafe import Markup
 from PIL import Image as PillowImage, ImageOps
-from sqlalchemy.event import listens_for
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from wtforms_alchemy.fields import QuerySelectMultipleField
-from wtforms.validators import DataRequired
+from wtforms.validators import DataRequired, ValidationError
 
 
-from config import (basedir,
-                    FILE_BASE_PATH, FILE_REL_PATH)
-from mct_app import admin, cache, csrf, db
+from config import (basedir, ContentType,
+                    FILE_BASE_PATH, STAGING_PATH)
+from mct_app import admin, blacklist, csrf, db
 from mct_app.administration.models import BannedIPs
 from mct_app.auth.models import (Answer, Consultation,
                                  DiaryRecommendation, Question,
-                                 Role, User, UserDiary,
-                                 UserRole, UserSession,
-                                 UserStatistics)
-from mct_app.search import add_to_index
+                                 ReadingProgress, Role, User, UserDiary,
+                                 UserPrincipal, UserRole, UserSession)
+from mct_app.caching import invalidate_tags
+from mct_app.search import search_stats
 from mct_app.site.models import (Article, ArticleCard, ArticleImage,
                                  Image as MyImage, News,
                                  TextbookChapter,
                                  TextbookParagraph, TextbookParagraphImage)
-from mct_app.utils import (generate_image_name, get_images_names,
-                           save_banned_ip_file, save_image_as_webp)
+from mct_app.utils import (encode_image, find_staged_image,
+                           generate_image_name, get_images_names,
+                           IMAGE_ERRORS, image_widths, normalize_banned_ip,
+                           save_banned_ip_file)
 
 
 administration = Blueprint('administration', __name__)
@@ -48,34 +51,117 @@ administration = Blueprint('administration', __name__)
 @administration.route('/files/<filename>')
 @csrf.exempt
 def uploaded_files(filename):
-    """Upload images."""
-    path = os.path.join(basedir, 'mct_app', 'files')
-    return send_from_directory(path, filename)
+    """Upload images.
+
+    Names of files are hashes of their content, so they are cached
+    forever. With FILES_ACCEL_REDIRECT set the front proxy sends the file.
+    """
+    path = safe_join(FILE_BASE_PATH, filename)
+    if path is None:
+        abort(404)
+    if not os.path.isfile(path):
+        # serve the original until the worker encodes it
+        staged = find_staged_image(filename)
+        if staged:
+            response = send_file(staged)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        abort(404)
+    etag = os.path.splitext(filename)[0]
+    max_age = current_app.config['FILES_MAX_AGE']
+    location = current_app.config['FILES_ACCEL_REDIRECT']
+    if location:
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = \
+            f"{location.rstrip('/')}/{quote(filename)}"
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:
+        # werkzeug handles ranges and gunicorn streams with sendfile
+        response = send_from_directory(FILE_BASE_PATH, filename,
+                                       etag=etag, max_age=max_age)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
 
 
 @administration.route('/upload', methods=['POST'])
 @csrf.exempt
 def upload(format='webp'):
-    """Upload and save images as WEBP."""
+    """Upload images and encode them as WEBP in the background.
+
+    Files are named by a hash of their content,
+    so uploading the same image again does nothing.
+    """
     image = request.files.get('upload')
     extension = image.filename.split('.')[-1].lower()
     if extension not in current_app.config.get('ALLOWED_EXTENSIONS'):
         return upload_fail(message='Это не изображение')
-    unique_filename = str(uuid.uuid4())
-    image.filename = unique_filename + '.' + format
+    data = image.read()
+    try:
+        PillowImage.open(BytesIO(data)).verify()
+    except IMAGE_ERRORS:
+        return upload_fail(message='Изображение повреждено')
+    image.filename = f'{hashlib.sha256(data).hexdigest()}.{format}'
     path = os.path.join(basedir, 'mct_app', 'files', image.filename)
-    save_image_as_webp(image, path)
+    if not os.path.exists(path) and not find_staged_image(image.filename):
+        os.makedirs(STAGING_PATH, exist_ok=True)
+        source = os.path.join(
+            STAGING_PATH, f'{os.path.splitext(image.filename)[0]}.{extension}')
+        with open(source, 'wb') as file:
+            file.write(data)
+        try:
+            encode_image.apply_async((source, path), retry=False)
+        except kombu.exceptions.OperationalError:
+            current_app.logger.exception('Image is encoded without Celery')
+            encode_image(source, path)
     url = url_for('administration.uploaded_files', filename=image.filename)
     return upload_success(url, filename=image.filename)
 
 
+@administration.route('/search-stats')
+def search_statistics():
+    """Show hits and misses of the search result cache."""
+    if not current_user.is_admin():
+        abort(403)
+    return jsonify(search_stats())
+
+
 class AccessView(ModelView):
     """Class provides access for only admin to admin panel."""
 
+    # cache tags of site pages showing this model
+    cache_tags = ()
+
+    def __init__(self, model, *args, **kwargs) -> None:
+        """Show stored excerpt instead of a deferred large column."""
+        source = getattr(model, '__excerpt_source__', None)
+        if source is not None:
+            self.column_formatters = {
+                source: lambda v, c, m, p: m.excerpt,
+                **(self.column_formatters or {})}
+            self.column_exclude_list = [
+                *(self.column_exclude_list or ()), 'excerpt']
+            self.form_excluded_columns = [
+                *(self.form_excluded_columns or ()), 'excerpt']
+        super(AccessView, self).__init__(model, *args, **kwargs)
+
     def is_accessible(self):
         """Check whether current user is admin or not."""
         return current_user.is_admin()
 
+    def after_model_change(self, form, model, is_created: bool) -> None:
+        """Make cached pages showing this model outdated."""
+        invalidate_tags(*self.cache_tags)
+        super(AccessView, self).after_model_change(form, model, is_created)
+
+    def after_model_delete(self, model) -> None:
+        """Make cached pages showing deleted model outdated."""
+        invalidate_tags(*self.cache_tags)
+        super(AccessView, self).after_model_delete(model)
+
 
 class MyAdminIndexView(flask_admin.AdminIndexView):
     """Class to forbid access for everyone to admin panel except admin."""
@@ -115,6 +201,17 @@ class UserView(AccessView):
         model.roles.append(user_role)
         super(UserView, self).on_model_change(form, model, is_created)
 
+    def after_model_change(self, form, model: User, is_created: bool
+                           ) -> None:
+        """Forget snapshot of the user after the new role is saved."""
+        model.reset_role()
+        super(UserView, self).after_model_change(form, model, is_created)
+
+    def after_model_delete(self, model: User) -> None:
+        """Forget snapshot of the deleted user."""
+        UserPrincipal.forget(model.id)
+        super(UserView, self).after_model_delete(model)
+
 
 class CustomImageUploadField(ImageUploadField):
     """Overridden class of ImageUploadField."""
@@ -137,6 +234,13 @@ class CustomImageUploadField(ImageUploadField):
 
         return image
 
+    def _save_file(self, data, filename):
+        # names are hashes of the content, so the file is the same image
+        saved_filename, _ = self._get_save_format(filename, self.image)
+        if op.exists(self._get_path(saved_filename)):
+            return saved_filename
+        return super(CustomImageUploadField, self)._save_file(data, filename)
+
     def _save_image(self, image, path, format='WEBP'):
         # New Pillow versions require RGB format for JPEGs
         if format == 'JPEG' and image.mode != 'RGB':
@@ -161,13 +265,10 @@ def add_article_image(article_id, article_body):
     images_names = get_images_names(text=article_body)
     article = db.session.query(Article).filter_by(id=article_id).first()
     if images_names:
-        for image_name in images_names:
+        for image_name in set(images_names):
             article_image = ArticleImage()
-            image = MyImage(
-                filename=image_name,
-                absolute_path=os.path.join(FILE_BASE_PATH, image_name),
-                relative_path=os.path.join(FILE_REL_PATH, image_name),
-            )
+            image = MyImage.for_file(
+                image_name, widths=image_widths(image_name))
             article_image.article = article
             image.articles.append(article_image)
 
@@ -178,6 +279,7 @@ class NewsView(AccessView):
     column_display_pk = True
     page_size = 10
     edit_template = 'admin/edit.html'
+    cache_tags = ('news',)
     column_default_sort = ('id', True)
     column_formatters = {
         'image': lambda v, c, m, p: Markup(
@@ -206,19 +308,7 @@ class NewsView(AccessView):
     def on_model_change(self, form, model: News, is_created: bool) -> None:
         """Allow to create ot edit news."""
         filename = secure_filename(form.extra.data.__dict__['filename'])
-        if is_created:
-            my_image = MyImage(
-                filename=filename,
-                absolute_path=os.path.join(FILE_BASE_PATH, filename),
-                relative_path=os.path.join(FILE_REL_PATH, filename))
-            model.image = my_image
-        else:
-            model.image.filename = filename
-            model.image.absolute_path = os.path.join(
-                FILE_BASE_PATH, filename)
-            model.image.relative_path = os.path.join(
-                FILE_REL_PATH, filename)
-        cache.clear()
+        model.image = MyImage.for_file(filename)
         super(NewsView, self).on_model_change(form, model, is_created)
 
 
@@ -231,6 +321,17 @@ class UserRoleView(AccessView):
     form_create_rules = ('user', 'role')
     form_edit_rules = ('user', 'role')
 
+    def after_model_change(self, form, model: UserRole, is_created: bool
+                           ) -> None:
+        """Forget snapshot of the user whose role was changed."""
+        UserPrincipal.forget(model.user_id)
+        super(UserRoleView, self).after_model_change(form, model, is_created)
+
+    def after_model_delete(self, model: UserRole) -> None:
+        """Forget snapshot of the user who lost the role."""
+        UserPrincipal.forget(model.user_id)
+        super(UserRoleView, self).after_model_delete(model)
+
 
 class UserSessionView(AccessView):
     """Class for view of UserSession model."""
@@ -249,14 +350,14 @@ class ArticleCardView(AccessView):
 
     column_default_sort = ('id', True)
     form_excluded_columns = ('image', 'article')
+    cache_tags = ('articles',)
     create_template = 'admin/edit.html'
     edit_template = 'admin/edit.html'
 
     column_formatters = {
         'image': lambda v, c, m, p: Markup(
             f'<img src="{m.image.relative_path}" width="100" height="100">'),
-        'article':
-        lambda v, c, m, p: m.article.body[:150] if m.article.body else None
+        'article': lambda v, c, m, p: m.article.excerpt
     }
 
     def on_form_prefill(self, form, id):
@@ -288,13 +389,7 @@ class ArticleCardView(AccessView):
         if is_created:
             # We are CREATING an articlecard and aricle
             # image of current card
-            my_image = MyImage(
-                filename=filename,
-                absolute_path=os.path.join(
-                    FILE_BASE_PATH, filename),
-                relative_path=os.path.join(
-                    FILE_REL_PATH, filename))
-            model.image = my_image
+            model.image = MyImage.for_file(filename)
 
             # a new article inside the card
             article = Article(title=model.title, body=form.body.data)
@@ -303,32 +398,17 @@ class ArticleCardView(AccessView):
             # fetch images inside article content
             image_names = get_images_names(model.article.body)
             if image_names:
-                for image_name in image_names:
+                for image_name in set(image_names):
                     article_image = ArticleImage()
-                    image = MyImage(
-                        filename=image_name,
-                        absolute_path=os.path.join(FILE_BASE_PATH, image_name),
-                        relative_path=os.path.join(FILE_REL_PATH, image_name),
-                    )
+                    image = MyImage.for_file(
+                        image_name, widths=image_widths(image_name))
                     article_image.image = image
                     model.article.images.append(article_image)
 
-            # update users statistics after adding a new article
-            statistics = UserStatistics.query.all()
-            for stat in statistics:
-                stat_dict = json.loads(stat.articles_statistics)
-                stat_dict.update({model.id: False})
-                stat.articles_statistics = json.dumps(stat_dict)
-            db.session.commit()
-
         else:
             # We are EDITING an articlecard and aricle
             # change image of the current card
-            model.image.filename = filename
-            model.image.absolute_path = os.path.join(
-                FILE_BASE_PATH, filename)
-            model.image.relative_path = os.path.join(
-                FILE_REL_PATH, filename)
+            model.image = MyImage.for_file(filename)
 
             # take articlecard title to current article
             model.article.title = model.title
@@ -362,25 +442,15 @@ class ArticleCardView(AccessView):
                 images_on_add = tuple(set(image_names) - prev_images)
                 for image_name in images_on_add:
                     article_image = ArticleImage()
-                    image = MyImage(filename=image_name,
-                                    absolute_path=os.path.join(
-                                        FILE_BASE_PATH, image_name),
-                                    relative_path=os.path.join(
-                                        FILE_REL_PATH, image_name))
+                    image = MyImage.for_file(
+                        image_name, widths=image_widths(image_name))
                     article_image.image = image
                     model.article.images.append(article_image)
-        cache.clear()
         super(ArticleCardView, self).on_model_change(form, model, is_created)
 
     def on_model_delete(self, model):
         """Delete chosen ArticleCard."""
-        statistics = UserStatistics.query.all()
-        for stat in statistics:
-            stat_dict = json.loads(stat.articles_statistics)
-            del stat_dict[str(model.article.id)]
-            stat.articles_statistics = json.dumps(stat_dict)
-        db.session.commit()
-        cache.clear()
+        ReadingProgress.forget(ContentType.ARTICLE, model.article_id)
         return super().on_model_delete(model)
 
 
@@ -388,33 +458,17 @@ class TextbookChapterView(AccessView):
     """Class for view of TextbookChapter model."""
 
     form_excluded_columns = ('textbook_paragraphs', )
-
-    def on_model_delete(self, model):
-        """Delete chosen TextbookChapter."""
-        deleted_keys = [
-            paragraph.id for paragraph in model.textbook_paragraphs]
-        statistics = UserStatistics.query.all()
-        for stat in statistics:
-            stat_dict = json.loads(stat.textbook_statistics)
-            for id in deleted_keys:
-                del stat_dict[str(id)]
-            stat.textbook_statistics = json.dumps(stat_dict)
-        db.session.commit()
-        cache.clear()
-        return super().on_model_delete(model)
+    cache_tags = ('textbook',)
 
 
 class TextbookParagraphView(AccessView):
     """Class for view of TextbookParagraph."""
 
     form_excluded_columns = ('images', 'content')
+    cache_tags = ('textbook',)
     create_template = 'admin/edit-paragraph.html'
     edit_template = 'admin/edit-paragraph.html'
 
-    column_formatters = {
-        'content': lambda v, c, m, p: m.content[:150] if m.content else None
-    }
-
     def on_form_prefill(self, form, id):
         """Prefill TExtbookParagraph form before editing."""
         model = self.get_one(id)
@@ -439,23 +493,12 @@ class TextbookParagraphView(AccessView):
             # get new images in the current paragraph
             image_names = get_images_names(model.content)
             if image_names:
-                for image_name in image_names:
+                for image_name in set(image_names):
                     paragraph_image = TextbookParagraphImage()
-                    image = MyImage(
-                        filename=image_name,
-                        absolute_path=os.path.join(FILE_BASE_PATH, image_name),
-                        relative_path=os.path.join(FILE_REL_PATH, image_name),
-                    )
+                    image = MyImage.for_file(
+                        image_name, widths=image_widths(image_name))
                     paragraph_image.image = image
                     model.images.append(paragraph_image)
-
-            # update users statistics after adding a new article
-            statistics = UserStatistics.query.all()
-            for stat in statistics:
-                stat_dict = json.loads(stat.textbook_statistics)
-                stat_dict.update({model.id: False})
-                stat.textbook_statistics = json.dumps(stat_dict)
-            db.session.commit()
         else:
             # We are EDITING a paragraph in the textbook
             # write paragraph content to model content
@@ -488,21 +531,10 @@ class TextbookParagraphView(AccessView):
                 images_on_add = tuple(set(image_names) - prev_images)
                 for image_name in images_on_add:
                     paragraph_image = TextbookParagraphImage()
-                    image = MyImage(
-                        filename=image_name,
-                        absolute_path=os.path.join(FILE_BASE_PATH, image_name),
-                        relative_path=os.path.join(FILE_REL_PATH, image_name),
-                    )
+                    image = MyImage.for_file(
+                        image_name, widths=image_widths(image_name))
                     paragraph_image.image = image
                     model.images.append(paragraph_image)
-        try:
-            add_to_index(model.__tablename__, model)
-        except elastic_transport.ConnectionError:
-            current_app.logger.exception(
-                'Paragrapth created without Elasticsearch')
-        except elasticsearch.NotFoundError:
-            current_app.logger.exception('Paragrapth has no Elasticsearch')
-        cache.clear()
         super(TextbookParagraphView, self).on_model_change(
             form,
             model,
@@ -510,27 +542,29 @@ class TextbookParagraphView(AccessView):
 
     def on_model_delete(self, model):
         """Detete chosen TextbookParagraph."""
-        statistics = UserStatistics.query.all()
-        for stat in statistics:
-            stat_dict = json.loads(stat.textbook_statistics)
-            del stat_dict[str(model.id)]
-            stat.textbook_statistics = json.dumps(stat_dict)
-        db.session.commit()
-        try:
-            TextbookParagraph.reindex()
-        except elastic_transport.ConnectionError:
-            current_app.logger.exception(
-                'Paragrapth deleted without Elasticsearch')
-        except elasticsearch.NotFoundError:
-            current_app.logger.exception('Paragrapth has no Elasticsearch')
-        cache.clear()
+        ReadingProgress.forget(ContentType.TEXTBOOK_PARAGRAPH, model.id)
+        # the document is removed from the index after commit
         return super().on_model_delete(model)
 
 
+def validate_banned_ip(form, field):
+    """Validate and normalize a banned IP address or CIDR range."""
+    try:
+        field.data = normalize_banned_ip(field.data)
+    except ValueError:
+        raise ValidationError(
+            'Введите IPv4/IPv6-адрес или диапазон в формате CIDR')
+
+
 class BannedIPsView(AccessView):
     """Class for view of BannedIPs in admin panel."""
 
     can_edit = False
+    form_args = {
+        'banned_ip': {
+            'label': 'IP-адрес или диапазон (CIDR)',
+            'validators': [DataRequired(), validate_banned_ip]}
+    }
 
     def on_model_change(self, form, model, is_created: bool) -> None:
         """Allow to create or edit banned IPs."""
@@ -538,6 +572,7 @@ class BannedIPsView(AccessView):
         if form.banned_ip.data not in banned_ip:
             banned_ip.append(form.banned_ip.data)
         save_banned_ip_file(banned_ip)
+        blacklist.notify_changed()
         super(BannedIPsView, self).on_model_change(form, model, is_created)
 
     def on_model_delete(self, model):
@@ -546,93 +581,10 @@ class BannedIPsView(AccessView):
         if model.banned_ip in banned_ip:
             banned_ip.remove(model.banned_ip)
         save_banned_ip_file(banned_ip)
+        blacklist.notify_changed()
         return super().on_model_delete(model)
 
 
-# SQLAlchemy Events
-@listens_for(News, 'after_delete')
-def delete_unused_news_images(mapper, connection, target: News):
-    """Delete image from SSD after database deletion of this image."""
-    if target:
-        try:
-            os.remove(target.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'News images arent deleted after news deleting')
-
-
-@listens_for(News, 'before_update')
-def delete_unused_news_images_before_update(mapper, connection, target: News):
-    """Delete image from SSD before database update of a new image."""
-    if target:
-        try:
-            os.remove(target.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'Unused News images arent deleted after update')
-
-
-@listens_for(ArticleCard, 'after_delete')
-def delete_unused_articlecard_images(mapper, connection, target: ArticleCard):
-    """Delete image from SSD after database deletion of this image."""
-    if target:
-        try:
-            os.remove(target.image.absolute_path)
-            if target.article.images:
-                for article_image in target.article.images:
-                    os.remove(article_image.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'Unused ArticleCard images arent'
-                ' deleted after article deleting')
-
-
-@listens_for(ArticleCard, 'before_update')
-def delete_unused_articlecard_images_before_update(mapper,
-                                                   connection,
-                                                   target: ArticleCard):
-    """Delete image from SSD before database update of a new image."""
-    if target:
-        try:
-            os.remove(target.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'Unused ArticleCard images arent'
-                ' deleted after article updating')
-
-
-@listens_for(TextbookParagraph, 'after_delete')
-def delete_unused_textbookparagraph_images(mapper,
-                                           connection,
-                                           target: TextbookParagraph):
-    """Delete image from SSD after database deletion of this image."""
-    if target:
-        try:
-            if target.images:
-                for image in target.images:
-                    os.remove(image.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'Unused TextbookParagraph images'
-                ' arent deleted after article deleting')
-
-
-@listens_for(db.session, 'after_flush')
-def delete_images_from_content(session, flush_content):
-    """Delete unused anymore images from Articles or TextbookParagraph."""
-    if session.deleted:
-        try:
-            for item in session.deleted:
-                if isinstance(item, ArticleImage):
-                    os.remove(item.image.absolute_path)
-                if isinstance(item, TextbookParagraphImage):
-                    os.remove(item.image.absolute_path)
-        except OSError:
-            current_app.logger.exception(
-                'Unused TextbookPar/Article images'
-                ' arent deleted after article deleting')
-
-
 # Admin view fill
 admin.add_link(MenuLink(name='На сайт', url='/'))
 admin.add_view(UserView(User, db.session, 'Пользователи'))
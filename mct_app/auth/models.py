@@ -1,26 +1,53 @@
+from collections import OrderedDict
 import csv
 from datetime import datetime
-import json
-from typing import List, Optional
+import threading
+import time
+from typing import Any, List, Optional
 import os
 
 from flask_login import AnonymousUserMixin, UserMixin
 from itsdangerous.url_safe import URLSafeTimedSerializer
 from itsdangerous import BadSignature
 from sqlalchemy import (Boolean, DateTime,
-                        Enum, ForeignKey,
-                        Integer, JSON,
+                        delete, Enum, ForeignKey,
+                        func, Index, Integer,
                         select, String,
                         UnicodeText)
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.orm import (joinedload, load_only, Mapped,
+                            mapped_column, query_expression, relationship)
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from config import Is, Mood
-from mct_app import db, login_manager
+from config import ContentType, Is, Mood
+from mct_app import cache, db, login_manager
+from mct_app.site.models import CountedMixin, ExcerptMixin
 from flask import current_app
 
 
-class User(UserMixin, db.Model):
+PRINCIPAL_KEY = 'principal/{}'
+
+
+class RoleMixin:
+    """Class for mixin checking a role of the user by its role_id."""
+
+    def is_admin(self):
+        """Check current user is the admin."""
+        return self.role_id == Is.ADMIN
+
+    def is_content_manager(self):
+        """Check current user is a content manager."""
+        return self.role_id == Is.CONTENT_MANAGER
+
+    def is_doctor(self):
+        """Check current user is a doctor."""
+        return self.role_id == Is.DOCTOR
+
+    def is_patient(self):
+        """Check current user is a patient."""
+        return self.role_id == Is.PATIENT
+
+
+class User(RoleMixin, UserMixin, db.Model):
     """Class for user model."""
 
     __tablename__ = "user"
@@ -47,12 +74,12 @@ class User(UserMixin, db.Model):
     question: Mapped['Question'] = relationship(back_populates='user')
     answers: Mapped[List['Answer']] = relationship(
         back_populates='user',
-        passive_deletes=True,
-        lazy='joined')
+        passive_deletes=True)
     consultation: Mapped['Consultation'] = relationship(back_populates='user')
-    user_statistics: Mapped['UserStatistics'] = relationship(
+    reading_progress: Mapped[List['ReadingProgress']] = relationship(
         back_populates='user',
-        cascade="all, delete")
+        cascade="all, delete",
+        passive_deletes=True)
     user_diaries: Mapped[List['UserDiary']] = relationship(
         back_populates='user',
         cascade="all, delete")
@@ -60,21 +87,19 @@ class User(UserMixin, db.Model):
         back_populates='user',
         cascade="all, delete")
 
-    def is_admin(self):
-        """Check current user is the admin."""
-        return self.roles[0].role_id == Is.ADMIN
-
-    def is_content_manager(self):
-        """Check current user is a content manager."""
-        return self.roles[0].role_id == Is.CONTENT_MANAGER
-
-    def is_doctor(self):
-        """Check current user is a doctor."""
-        return self.roles[0].role_id == Is.DOCTOR
+    @property
+    def role_id(self) -> Optional[int]:
+        """Return id of user's role resolved once per instance."""
+        try:
+            return self._role_id
+        except AttributeError:
+            self._role_id = self.roles[0].role_id if self.roles else None
+            return self._role_id
 
-    def is_patient(self):
-        """Check current user is a patient."""
-        return self.roles[0].role_id == Is.PATIENT
+    def reset_role(self) -> None:
+        """Forget resolved role after the roles were changed."""
+        self.__dict__.pop('_role_id', None)
+        UserPrincipal.forget(self.id)
 
     @property
     def password(self):
@@ -101,13 +126,6 @@ class User(UserMixin, db.Model):
                 email=os.environ.get('ADMIN_EMAIL'))
             db.session.add(admin)
             db.session.commit()
-            admin_statistics = UserStatistics(
-                articles_statistics=json.dumps({}),
-                textbook_statistics=json.dumps({}),
-                user_id=Is.ADMIN
-            )
-            db.session.add(admin_statistics)
-            db.session.commit()
 
     def reset_password(self, token, new_password):
         """Reset user's password."""
@@ -123,6 +141,7 @@ class User(UserMixin, db.Model):
         self.password = new_password
         db.session.add(self)
         db.session.commit()
+        UserPrincipal.forget(self.id)
         return True
 
     def generate_password_reset_token(self):
@@ -216,25 +235,26 @@ class SocialAccount(db.Model):
     user: Mapped['User'] = relationship(back_populates='social_account')
 
 
-class Question(db.Model):
+class Question(CountedMixin, ExcerptMixin, db.Model):
     """Class for questions."""
 
     __tablename__ = 'question'
+    __counter__ = 'questions'
+    __excerpt_source__ = 'body'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     anon_name: Mapped[str] = mapped_column(String(45), nullable=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('user.id'), nullable=True)
-    body: Mapped[str] = mapped_column(UnicodeText)
-    date: Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)
+    body: Mapped[str] = mapped_column(UnicodeText, deferred=True)
+    date: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, index=True, default=datetime.now)
     ip_address: Mapped[str] = mapped_column(String(45))
+    answers_count: Mapped[int] = query_expression()
 
     answers: Mapped[List['Answer']] = relationship(
         back_populates='question',
-        cascade='all, delete',
-        lazy='joined')
-    user: Mapped['User'] = relationship(
-        back_populates='question',
-        lazy='joined')
+        cascade='all, delete')
+    user: Mapped['User'] = relationship(back_populates='question')
 
     def __repr__(self) -> str:
         """Show question instance in the terminal."""
@@ -253,10 +273,9 @@ class Answer(db.Model):
     user_id: Mapped[Optional[int]] = mapped_column(
         ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
 
-    user: Mapped[Optional['User']] = relationship(
-        back_populates='answers', lazy='joined')
+    user: Mapped[Optional['User']] = relationship(back_populates='answers')
     question: Mapped[Optional['Question']] = relationship(
-        back_populates='answers', lazy='joined')
+        back_populates='answers')
 
     def __repr__(self) -> str:
         """Show Answer instance in the terminal."""
@@ -278,29 +297,95 @@ class Consultation(db.Model):
     user: Mapped['User'] = relationship(back_populates='consultation')
 
 
-class UserStatistics(db.Model):
-    """Class for user's statistics."""
-
-    __tablename__ = 'user_statistics'
+class ReadingProgress(db.Model):
+    """Class for articles and textbook paragraphs read by a user."""
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    articles_statistics: Mapped[dict[str]] = mapped_column(JSON)
-    textbook_statistics: Mapped[dict[str]] = mapped_column(JSON)
+    __tablename__ = 'reading_progress'
+    __table_args__ = (
+        Index('ix_reading_progress_content', 'content_type', 'content_id'),
+    )
 
     user_id: Mapped[int] = mapped_column(
-        ForeignKey('user.id', ondelete='CASCADE'))
-    user: Mapped['User'] = relationship(back_populates='user_statistics')
+        ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    content_type: Mapped[str] = mapped_column(String(20), primary_key=True)
+    content_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    read_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    user: Mapped['User'] = relationship(back_populates='reading_progress')
+
+    @staticmethod
+    def has_read(user_id: int,
+                 content_type: ContentType,
+                 content_id: int) -> bool:
+        """Check whether user has read particular content."""
+        return db.session.get(
+            ReadingProgress, (user_id, content_type, content_id)) is not None
 
+    @staticmethod
+    def toggle(user_id: int,
+               content_type: ContentType,
+               content_id: int) -> bool:
+        """Mark content as read or unread and return a new state."""
+        progress = db.session.get(
+            ReadingProgress, (user_id, content_type, content_id))
+        if progress is None:
+            db.session.add(ReadingProgress(
+                user_id=user_id,
+                content_type=content_type,
+                content_id=content_id,
+                read_at=datetime.now()))
+        else:
+            db.session.delete(progress)
+        db.session.commit()
+        return progress is None
+
+    @staticmethod
+    def read_ids(user_id: int, content_type: ContentType) -> set[int]:
+        """Return ids of all the content of a type read by user."""
+        query = select(ReadingProgress.content_id).where(
+            ReadingProgress.user_id == user_id,
+            ReadingProgress.content_type == content_type)
+        return set(db.session.scalars(query))
 
-class UserDiary(db.Model):
+    @staticmethod
+    def forget(content_type: ContentType, *content_ids: int) -> None:
+        """Remove marks of deleted content for all users in one query."""
+        if not content_ids:
+            return
+        db.session.execute(delete(ReadingProgress).where(
+            ReadingProgress.content_type == content_type,
+            ReadingProgress.content_id.in_(content_ids)))
+
+    @staticmethod
+    def get_percent(user_id: int,
+                    content_type: ContentType,
+                    content_model: type[db.Model]) -> int:
+        """Return percentage of existing content of a type read by user."""
+        total = db.session.scalar(
+            select(func.count()).select_from(content_model))
+        if not total:
+            return 0
+        done = db.session.scalar(
+            select(func.count()).select_from(ReadingProgress).join(
+                content_model,
+                content_model.id == ReadingProgress.content_id).where(
+                    ReadingProgress.user_id == user_id,
+                    ReadingProgress.content_type == content_type))
+        return int(done * 100 / total)
+
+
+class UserDiary(CountedMixin, ExcerptMixin, db.Model):
     """Class for user's diary."""
 
     __tablename__ = 'user_diary'
+    __counter__ = 'diary/{user_id}'
+    __counter_by__ = ('user_id',)
+    __excerpt_source__ = 'record'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     date: Mapped[datetime] = mapped_column(DateTime, index=True)
     mood: Mapped[List[str]] = mapped_column(Enum(Mood))
-    record: Mapped[str] = mapped_column(UnicodeText)
+    record: Mapped[str] = mapped_column(UnicodeText, deferred=True)
     user_id: Mapped[int] = mapped_column(
         ForeignKey('user.id', ondelete='CASCADE'))
     user: Mapped['User'] = relationship(back_populates='user_diaries')
@@ -332,6 +417,8 @@ class DiaryRecommendation(db.Model):
 class AnonymousUser(AnonymousUserMixin):
     """Class for anonymous user."""
 
+    role_id = None
+
     def is_anonymous(self):
         """Check whether current user is anonymous."""
         return True
@@ -344,11 +431,103 @@ class AnonymousUser(AnonymousUserMixin):
         """Check whether current user is admin."""
         return False
 
+    def is_content_manager(self):
+        """Check whether current user is a content manager."""
+        return False
+
+    def is_patient(self):
+        """Check whether current user is a patient."""
+        return False
+
+
+class UserPrincipal(RoleMixin, UserMixin):
+    """Class for a lightweight snapshot of the logged in user.
+
+    Snapshots are kept in Redis for PRINCIPAL_CACHE_TTL seconds and
+    in a small in-process LRU for PRINCIPAL_LOCAL_TTL seconds.
+    Any other attribute is read from the ORM user loaded on demand.
+    """
+
+    _local = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, snapshot: dict[str, Any]) -> None:
+        """Initialize the principal from a snapshot."""
+        self.id = snapshot['id']
+        self.username = snapshot['username']
+        self.role_id = snapshot['role_id']
+        self.has_social_account = snapshot['has_social_account']
+        self._user = None
+
+    def __getattr__(self, name: str) -> Any:
+        """Read attributes missing in the snapshot from the ORM user."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return getattr(self._user, name)
+
+    @staticmethod
+    def load(user_id: int) -> Optional['UserPrincipal']:
+        """Return principal of a user from cache or database."""
+        snapshot = UserPrincipal._get_local(user_id)
+        if snapshot is None:
+            snapshot = cache.get(PRINCIPAL_KEY.format(user_id))
+            if snapshot is None:
+                row = db.session.execute(
+                    select(User.id, User.username, User.has_social_account,
+                           UserRole.role_id).outerjoin(User.roles).where(
+                               User.id == user_id)).first()
+                if row is None:
+                    return None
+                snapshot = row._asdict()
+                cache.set(PRINCIPAL_KEY.format(user_id), snapshot,
+                          timeout=current_app.config['PRINCIPAL_CACHE_TTL'])
+            UserPrincipal._set_local(user_id, snapshot)
+        return UserPrincipal(snapshot)
+
+    @staticmethod
+    def forget(user_id: int) -> None:
+        """Drop cached snapshot after the user was changed."""
+        with UserPrincipal._lock:
+            UserPrincipal._local.pop(user_id, None)
+        cache.delete(PRINCIPAL_KEY.format(user_id))
+
+    @staticmethod
+    def _get_local(user_id: int) -> Optional[dict[str, Any]]:
+        """Return fresh snapshot from the in-process LRU."""
+        with UserPrincipal._lock:
+            entry = UserPrincipal._local.get(user_id)
+            if entry is None:
+                return None
+            snapshot, expires_at = entry
+            if expires_at < time.monotonic():
+                del UserPrincipal._local[user_id]
+                return None
+            UserPrincipal._local.move_to_end(user_id)
+            return snapshot
+
+    @staticmethod
+    def _set_local(user_id: int, snapshot: dict[str, Any]) -> None:
+        """Put snapshot into the in-process LRU."""
+        config = current_app.config
+        with UserPrincipal._lock:
+            UserPrincipal._local[user_id] = (
+                snapshot, time.monotonic() + config['PRINCIPAL_LOCAL_TTL'])
+            UserPrincipal._local.move_to_end(user_id)
+            while len(UserPrincipal._local) > config['PRINCIPAL_LRU_SIZE']:
+                UserPrincipal._local.popitem(last=False)
+
 
 login_manager.anonymous_user = AnonymousUser
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    """Load current user to get id."""
-    return User.query.get(int(user_id))
+    """Load current user with his role in a single query."""
+    if current_app.config['PRINCIPAL_CACHE']:
+        return UserPrincipal.load(int(user_id))
+    query = select(User).options(
+        load_only(User.id, User.username),
+        joinedload(User.roles)).where(User.id == int(user_id))
+    return db.session.execute(query).unique().scalar_one_or_none()
@@ -2,7 +2,6 @@ from datetime import datetime
 import hashlib
 import hmac
 from http import HTTPStatus
-import json
 import os
 from urllib.parse import urlsplit
 import uuid
@@ -19,24 +18,28 @@ import kombu
 from pip._vendor import cachecontrol
 import requests
 from sqlalchemy import select
+from sqlalchemy.orm import undefer
 
 
-from config import basedir, Is, Mood, SocialPlatform
-from mct_app import cache
+from config import basedir, ContentType, Is, Mood, SocialPlatform
 from mct_app.auth.models import (db, DiaryRecommendation,
-                                 SocialAccount, User,
-                                 UserDiary, UserRole,
-                                 UserSession, UserStatistics)
+                                 ReadingProgress, SocialAccount,
+                                 User, UserDiary,
+                                 UserRole, UserSession)
 from mct_app.auth.forms import (LoginForm, NewDiaryForm,
                                 RecommendationForm, RegistrationForm,
                                 RequestResetPasswordForm, ResetPasswordForm)
+from mct_app.caching import invalidate_user_namespace
 from mct_app.email import send_email
+from mct_app.pagination import keyset_paginate
 from mct_app.site.models import Article, TextbookParagraph
-from mct_app.utils import get_random_email, get_statistics_data
+from mct_app.utils import get_random_email
 
 
 auth = Blueprint('auth', __name__)
 
+DIARY_PER_PAGE = 5
+
 BOT_TOKEN_HASH = hashlib.sha256(os.environ['BOT_TOKEN'].encode())
 client_secrets_file = os.path.join(basedir, 'client_secret.json')
 
@@ -72,10 +75,9 @@ def registration():
         db.session.add(user)
         db.session.commit()
 
-        _create_user_statistics(user.id)
         _create_user_session(user)
         login_user(user)
-        cache.clear()
+        invalidate_user_namespace(user.id)
         return redirect(url_for('auth.profile', username=user.username))
     return render_template('forms/registration.html', form=form)
 
@@ -103,7 +105,7 @@ def login():
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('auth.profile', username=user.username)
-        cache.clear()
+        invalidate_user_namespace(user.id)
         return redirect(url_for('auth.profile', username=user.username))
     return render_template('forms/login.html', form=form)
 
@@ -113,8 +115,7 @@ def login():
 def profile(username):
     """Render profile page."""
     if current_user.username != request.view_args['username']:
-        role_id = current_user.roles[0].role_id
-        if role_id not in (Is.ADMIN, Is.DOCTOR):
+        if current_user.role_id not in (Is.ADMIN, Is.DOCTOR):
             current_app.logger.exception(
                 f'User {username} is not ADMIN and DOCTOR')
             abort(403)
@@ -132,10 +133,10 @@ def profile(username):
 @login_required
 def user_statistics(username):
     """Render user's statistics page."""
-    articles = json.loads(current_user.user_statistics.articles_statistics)
-    textbooks = json.loads(current_user.user_statistics.textbook_statistics)
-    articles_percent = get_statistics_data(articles)
-    textbooks_percent = get_statistics_data(textbooks)
+    articles_percent = ReadingProgress.get_percent(
+        current_user.id, ContentType.ARTICLE, Article)
+    textbooks_percent = ReadingProgress.get_percent(
+        current_user.id, ContentType.TEXTBOOK_PARAGRAPH, TextbookParagraph)
     return render_template(
         'profile/statistics.html',
         articles_percent=articles_percent,
@@ -158,28 +159,25 @@ def user_diary(username):
         db.session.commit()
         return redirect(
             url_for('auth.user_diary', username=current_user.username))
-    page = request.args.get('page', 1, type=int)
     if current_user.is_admin() or current_user.is_doctor():
-        query = select(
-            UserDiary).filter_by(
-                user_id=User.query.filter_by(
-                    username=username).first().id).order_by(
-                        UserDiary.date.desc())
+        user_id = User.query.filter_by(username=username).first().id
     else:
-        query = select(
-            UserDiary).filter_by(
-                user_id=current_user.id).order_by(UserDiary.date.desc())
-    diary_records = db.paginate(query, page=page, per_page=5, error_out=False)
+        user_id = current_user.id
+    query = select(UserDiary).filter_by(user_id=user_id).options(
+        undefer(UserDiary.record))
+    diary_records = keyset_paginate(
+        query, UserDiary.date, UserDiary.id, DIARY_PER_PAGE,
+        f'diary/{user_id}')
     pages_amount = diary_records.pages
     active_page = diary_records.page
     current_site = 'auth.user_diary'
     next_url = url_for(
         'auth.user_diary',
-        username=current_user.username, page=diary_records.next_num) \
+        username=current_user.username, cursor=diary_records.next_cursor) \
         if diary_records.has_next else None
     prev_url = url_for(
         'auth.user_diary',
-        username=current_user.username, page=diary_records.prev_num) \
+        username=current_user.username, cursor=diary_records.prev_cursor) \
         if diary_records.has_prev else None
     
     data = {
@@ -227,7 +225,8 @@ def delete_diary_record(username, diary_id):
 @login_required
 def edit_diary_record(username, diary_id):
     """Edit chosen diary record."""
-    diary = UserDiary.query.get_or_404(diary_id)
+    diary = UserDiary.query.options(
+        undefer(UserDiary.record)).get_or_404(diary_id)
     form = NewDiaryForm(obj=diary)
     if form.validate_on_submit():
         diary.mood = Mood(form.mood.data).name
@@ -242,7 +241,8 @@ def edit_diary_record(username, diary_id):
 @login_required
 def give_recommendation(username, diary_id):
     """Allow to write a recommendation on diary record."""
-    diary = UserDiary.query.get_or_404(diary_id)
+    diary = UserDiary.query.options(
+        undefer(UserDiary.record)).get_or_404(diary_id)
     form = RecommendationForm()
     if form.validate_on_submit():
         recommendation = DiaryRecommendation(
@@ -270,8 +270,9 @@ def delete_recommendation(username, recommed_id):
 @auth.route('/logout')
 def logout():
     """Sign out user."""
+    if current_user.is_authenticated:
+        invalidate_user_namespace(current_user.id)
     logout_user()
-    cache.clear()
     session.clear()
     return redirect('/')
 
@@ -606,6 +607,7 @@ def social_registration(name, email, social_platform, uid, phone=None):
     if user and user.has_social_account and user.social_uid == uid:
         login_user(user)
         _update_user_session(user)
+        invalidate_user_namespace(user.id)
         return user
     elif user and user.has_social_account and user.social_uid != uid:
         current_app.logger.error(
@@ -637,7 +639,6 @@ def social_registration(name, email, social_platform, uid, phone=None):
         db.session.add(user)
         db.session.commit()
 
-        _create_user_statistics(user.id)
         _create_user_session(user)
         login_user(user)
         _update_user_session(user)
@@ -666,25 +667,3 @@ def _update_user_session(user):
         db.session.commit()
     else:
         _create_user_session(user)
-
-
-def _add_user_statistics():
-    articles = {id[0]: False for id in db.session.query(Article.id).all()}
-    textbooks = {
-        id[0]: False for id in db.session.query(TextbookParagraph.id).all()}
-    return articles, textbooks
-
-
-def _create_user_statistics(user_id):
-    article_stat, textbook_stat = _add_user_statistics()
-
-    articles_statistics = json.dumps(article_stat)
-    textbook_statistics = json.dumps(textbook_stat)
-
-    statistics = UserStatistics(
-        articles_statistics=articles_statistics,
-        textbook_statistics=textbook_statistics,
-        user_id=user_id
-    )
-    db.session.add(statistics)
-    db.session.commit()
@@ -0,0 +1,223 @@
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import current_app, Flask
+import redis
+
+"""
+These are the tools for checking visitors against the banned IPs file.
+Every worker keeps the file parsed in memory and reloads it only
+when the file is replaced or another worker reports a change via Redis.
+"""
+
+BLACKLIST_CHANNEL = 'banned_ip:changed'
+LISTENER_RETRY_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+class _RadixNode:
+    """Class of a single node of the radix tree."""
+
+    __slots__ = ('bits', 'length', 'children', 'terminal')
+
+    def __init__(self, bits: int, length: int, terminal: bool = False
+                 ) -> None:
+        """Initialize node of a prefix with the given length."""
+        self.bits = bits
+        self.length = length
+        self.children = [None, None]
+        self.terminal = terminal
+
+
+class RadixTree:
+    """Class of path-compressed (Patricia) tree of CIDR networks.
+
+    Every lookup walks at most one node per differing bit,
+    so its cost depends on prefix length rather than list size.
+    """
+
+    def __init__(self) -> None:
+        """Initialize empty trees for IPv4 and IPv6."""
+        self._roots = {4: _RadixNode(0, 0), 6: _RadixNode(0, 0)}
+        self._size = 0
+
+    def __len__(self) -> int:
+        """Return amount of stored networks."""
+        return self._size
+
+    def insert(self, network: ipaddress.IPv4Network | ipaddress.IPv6Network
+               ) -> None:
+        """Add a network to the tree."""
+        width = network.max_prefixlen
+        bits = int(network.network_address)
+        length = network.prefixlen
+        node = self._roots[network.version]
+        self._size += 1
+        while True:
+            if node.length == length:
+                node.terminal = True
+                return
+            if node.terminal:
+                # the network is already covered by a wider one
+                return
+            bit = (bits >> (width - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _RadixNode(bits, length, terminal=True)
+                return
+            diff = bits ^ child.bits
+            common = width - diff.bit_length() if diff else width
+            common = min(common, length, child.length)
+            if common == child.length:
+                node = child
+                continue
+            # split the edge to the child at the first differing bit
+            mask = ((1 << common) - 1) << (width - common)
+            middle = _RadixNode(bits & mask, common, terminal=common == length)
+            middle.children[(child.bits >> (width - common - 1)) & 1] = child
+            if not middle.terminal:
+                middle.children[(bits >> (width - common - 1)) & 1] = \
+                    _RadixNode(bits, length, terminal=True)
+            node.children[bit] = middle
+            return
+
+    def __contains__(self,
+                     address: ipaddress.IPv4Address | ipaddress.IPv6Address
+                     ) -> bool:
+        """Check whether an address belongs to any stored network."""
+        width = address.max_prefixlen
+        bits = int(address)
+        node = self._roots[address.version]
+        while node is not None:
+            if (bits ^ node.bits) >> (width - node.length):
+                return False
+            if node.terminal:
+                return True
+            if node.length == width:
+                return False
+            node = node.children[(bits >> (width - node.length - 1)) & 1]
+        return False
+
+
+class IPBlacklist:
+    """Class of banned IPs matcher living in every worker."""
+
+    def __init__(self, app: Flask | None = None) -> None:
+        """Construct an empty blacklist."""
+        self._path = None
+        self._redis_url = None
+        self._check_interval = 1
+        self._addresses = frozenset()
+        self._networks = RadixTree()
+        self._file_id = None
+        self._checked_at = 0.0
+        self._stale = True
+        self._listener_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        """Initialize of current app."""
+        self._path = app.config.get('BANNED_IP_PATH')
+        self._redis_url = app.config.get('CACHE_REDIS_URL')
+        self._check_interval = app.config.get('BANNED_IP_CHECK_INTERVAL', 1)
+        self._stale = True
+        app.extensions['blacklist'] = self
+
+    def is_banned(self, ip: str | None) -> bool:
+        """Check whether an IP is in the blacklist."""
+        self._refresh()
+        if ip is None:
+            return False
+        if ip in self._addresses:
+            return True
+        if not self._networks:
+            return False
+        try:
+            return ipaddress.ip_address(ip) in self._networks
+        except ValueError:
+            return False
+
+    def notify_changed(self) -> None:
+        """Tell all the workers that the banned IPs file was rewritten."""
+        self._stale = True
+        if not self._redis_url:
+            return
+        try:
+            redis.Redis.from_url(self._redis_url).publish(
+                BLACKLIST_CHANNEL, 'changed')
+        except redis.exceptions.RedisError:
+            current_app.logger.exception(
+                'Banned IPs change is not published to Redis')
+
+    def _refresh(self) -> None:
+        """Reload banned IPs if the file was changed."""
+        self._start_listener()
+        now = time.monotonic()
+        if not self._stale and now - self._checked_at < self._check_interval:
+            return
+        self._checked_at = now
+        try:
+            stat = os.stat(self._path)
+            file_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except (OSError, TypeError):
+            file_id = None
+        if self._stale or file_id != self._file_id:
+            self._stale = False
+            self._load(file_id)
+
+    def _load(self, file_id: tuple[int, int, int] | None) -> None:
+        """Parse banned IPs file into a set and a radix tree."""
+        entries = []
+        if file_id is not None:
+            try:
+                with open(self._path) as file:
+                    entries = json.load(file)
+            except (OSError, ValueError):
+                logger.exception('Banned IPs file can not be read')
+                return
+        if isinstance(entries, dict):
+            entries = entries.get('addresses', []) + \
+                entries.get('networks', [])
+        addresses = set()
+        networks = RadixTree()
+        for entry in entries:
+            try:
+                if '/' in entry:
+                    networks.insert(ipaddress.ip_network(entry, strict=False))
+                else:
+                    addresses.add(str(ipaddress.ip_address(entry)))
+            except ValueError:
+                logger.warning('Wrong banned IP entry %s', entry)
+        self._addresses = frozenset(addresses)
+        self._networks = networks
+        self._file_id = file_id
+
+    def _start_listener(self) -> None:
+        """Subscribe to blacklist changes once in every worker process."""
+        if not self._redis_url or self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        threading.Thread(
+            target=self._listen,
+            name='blacklist-listener',
+            daemon=True).start()
+
+    def _listen(self) -> None:
+        """Mark blacklist as stale after every message from Redis."""
+        while True:
+            try:
+                pubsub = redis.Redis.from_url(self._redis_url).pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(BLACKLIST_CHANNEL)
+                for _ in pubsub.listen():
+                    self._stale = True
+            except redis.exceptions.RedisError:
+                logger.warning('Banned IPs listener lost Redis connection')
+                self._stale = True
+                time.sleep(LISTENER_RETRY_DELAY)
@@ -0,0 +1,63 @@
+from typing import Callable
+
+from flask import request
+from flask_login import current_user
+
+from mct_app import cache
+
+"""
+These are the helpers for building cache keys.
+Pages depending on the current visitor are cached in a namespace
+of this visitor, so login or logout invalidates only his own pages.
+Pages depending on content declare tags (e.g. 'news', 'textbook'),
+and every tag has a version which is a part of the cache key,
+so bumping a tag makes outdated only the pages depending on it.
+"""
+
+ANONYMOUS_NAMESPACE = 'anon'
+SHARED_NAMESPACE = 'shared'
+USER_NAMESPACE_KEY = 'namespace/user/{}'
+TAG_VERSION_KEY = 'tag/{}'
+
+
+def user_namespace() -> str:
+    """Return cache namespace of the current visitor."""
+    if not current_user.is_authenticated:
+        return ANONYMOUS_NAMESPACE
+    version = cache.get(USER_NAMESPACE_KEY.format(current_user.id)) or 0
+    return f'user/{current_user.id}/{version}'
+
+
+def invalidate_user_namespace(user_id: int) -> None:
+    """Make all the cached pages of a particular user outdated."""
+    cache.cache.inc(USER_NAMESPACE_KEY.format(user_id))
+
+
+def user_cache_key() -> str:
+    """Return cache key of the current page for the current visitor."""
+    return f'view/{user_namespace()}{request.path}'
+
+
+def tags_version(*tags: str) -> str:
+    """Return current versions of tags as a part of a cache key."""
+    if not tags:
+        return ''
+    versions = cache.get_many(*[TAG_VERSION_KEY.format(tag) for tag in tags])
+    return '.'.join(str(version or 0) for version in versions)
+
+
+def invalidate_tags(*tags: str) -> None:
+    """Make all the cached pages depending on tags outdated."""
+    for tag in tags:
+        cache.cache.inc(TAG_VERSION_KEY.format(tag))
+
+
+def tagged_cache_key(*tags: str,
+                     per_user: bool = False,
+                     key: str | None = None) -> Callable[[], str]:
+    """Return key_prefix function for a cached view depending on tags."""
+    def make_cache_key() -> str:
+        namespace = user_namespace() if per_user else SHARED_NAMESPACE
+        page = key or request.path.lstrip('/')
+        return f'view/{namespace}/{page}/{tags_version(*tags)}'
+    return make_cache_key
@@ -0,0 +1,153 @@
+from datetime import datetime
+import math
+from typing import Any
+
+from flask import current_app, request
+from itsdangerous import BadSignature
+from itsdangerous.url_safe import URLSafeSerializer
+from sqlalchemy import Select, tuple_
+
+from mct_app import db
+from mct_app.site.models import ContentCounter
+
+"""
+These are the tools for keyset (seek) pagination of feeds.
+Instead of OFFSET every page continues from the last row
+of the previous one, so deep pages cost as much as the first one.
+Cursors are signed tokens with the page number and the sort key
+of the boundary row; numbered links of the paginator still use
+OFFSET as a fallback. Total amount of rows is read from
+a maintained counter, so the paginator does not run COUNT(*).
+"""
+
+CURSOR_SALT = 'keyset-cursor'
+
+
+class KeysetPage:
+    """Class for a single page of a feed sorted by date descending."""
+
+    def __init__(self,
+                 items: list[Any],
+                 page: int,
+                 per_page: int,
+                 total: int,
+                 next_cursor: str | None,
+                 prev_cursor: str | None) -> None:
+        """Initialize a page with its neighbour cursors."""
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def pages(self) -> int:
+        """Return approximate amount of pages."""
+        return max(self.page, math.ceil(self.total / self.per_page))
+
+    @property
+    def has_next(self) -> bool:
+        """Check whether there is a next page."""
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self) -> bool:
+        """Check whether there is a previous page."""
+        return self.prev_cursor is not None
+
+
+def _serializer() -> URLSafeSerializer:
+    """Return serializer signing cursor tokens."""
+    return URLSafeSerializer(current_app.config['SECRET_KEY'],
+                             salt=CURSOR_SALT)
+
+
+def make_cursor(page: int, direction: str, row: Any,
+                date_column: Any, id_column: Any) -> str:
+    """Return token pointing before or after a boundary row.
+
+    Sort columns of feeds are not nullable, so every row has a key.
+    """
+    return _serializer().dumps([
+        page,
+        direction,
+        getattr(row, date_column.key).isoformat(),
+        getattr(row, id_column.key)])
+
+
+def load_cursor(token: str) -> tuple[int, str, datetime, int] | None:
+    """Return page, direction and sort key of a cursor token.
+
+    Return None for a missing, forged or malformed token.
+    """
+    if not token:
+        return None
+    try:
+        page, direction, date, row_id = _serializer().loads(token)
+    except (BadSignature, TypeError, ValueError):
+        return None
+    if not all((isinstance(page, int), isinstance(date, str),
+                isinstance(row_id, int), direction in ('next', 'prev'))):
+        return None
+    try:
+        return max(page, 1), direction, datetime.fromisoformat(date), row_id
+    except ValueError:
+        return None
+
+
+def keyset_paginate(query: Select,
+                    date_column: Any,
+                    id_column: Any,
+                    per_page: int,
+                    counter: str) -> KeysetPage:
+    """Return a page of a feed sorted by date and id descending.
+
+    The page is chosen by the cursor argument of the request,
+    or by the page argument when there is no cursor.
+    Amount of pages is taken from the counter with the given name.
+    """
+    key = tuple_(date_column, id_column)
+    cursor = load_cursor(request.args.get('cursor', ''))
+    if cursor is None:
+        # without a valid cursor the page is chosen by its number
+        page = max(request.args.get('page', 1, type=int), 1)
+        rows = db.session.scalars(
+            query.order_by(date_column.desc(), id_column.desc()).offset(
+                (page - 1) * per_page).limit(per_page + 1)).unique().all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = page > 1
+    else:
+        page, direction, date, row_id = cursor
+        if direction == 'prev':
+            # walk backwards from the first row of the next page
+            rows = db.session.scalars(
+                query.where(key > tuple_(date, row_id)).order_by(
+                    date_column.asc(), id_column.asc()).limit(
+                        per_page + 1)).unique().all()
+            has_prev = len(rows) > per_page and page > 1
+            items = rows[:per_page][::-1]
+            has_next = True
+        else:
+            rows = db.session.scalars(
+                query.where(key < tuple_(date, row_id)).order_by(
+                    date_column.desc(), id_column.desc()).limit(
+                        per_page + 1)).unique().all()
+            has_next = len(rows) > per_page
+            items = rows[:per_page]
+            has_prev = True
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = make_cursor(
+            page + 1, 'next', items[-1], date_column, id_column)
+    if items and has_prev:
+        prev_cursor = make_cursor(
+            page - 1, 'prev', items[0], date_column, id_column)
+    return KeysetPage(items=items,
+                      page=page,
+                      per_page=per_page,
+                      total=ContentCounter.get(counter, query),
+                      next_cursor=next_cursor,
+                      prev_cursor=prev_cursor)
@@ -1,42 +1,407 @@
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from collections.abc import Iterable
+import logging
+import re
+import time
 from typing import Any
 
+from celery import shared_task
+import elastic_transport
+import elasticsearch
+from elasticsearch import helpers
 from flask import current_app
+import kombu
+from markupsafe import escape, Markup
+import redis
+from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy.dialects.postgresql import (to_tsvector, ts_headline,
+                                            websearch_to_tsquery)
+from sqlalchemy.orm import undefer
+
+from config import EXCERPT_LENGTH
+from mct_app import cache, db
+from mct_app.caching import invalidate_tags
 
 """
 These are the main functions for manipulating Elasticsearch.
 You can do a full-text search.
+Changes of searchable models are not sent from the request:
+they are collected in a Redis set of (index, id) pairs
+and flushed by a Celery task through the bulk API.
+Every index name is an alias, so a full reindex is built
+into a fresh versioned index and swapped in atomically.
+Result pages are cached by a normalized query, and the cache
+of an index is made outdated whenever documents are sent to it.
+Searching itself goes through a backend chosen by config:
+Elasticsearch, or the database when the cluster is unavailable.
 """
 
+PENDING_KEY = 'search:pending'
+SEARCH_CACHE_KEY = 'search/{}/{}/{}/{}'
+SEARCH_TAG = 'search/{}'
+SEARCH_STATS_KEY = 'search/stats/{}'
+RUSSIAN_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'иях', 'ях', 'ах', 'ией', 'ей', 'ой', 'ий',
+    'ый', 'ая', 'яя', 'ое', 'ее', 'ие', 'ые', 'ого', 'его', 'ому', 'ему',
+    'ими', 'ыми', 'ом', 'ем', 'ам', 'ям', 'ов', 'ев', 'ию', 'ью', 'ия',
+    'ья', 'ии', 'ать', 'ять', 'ить', 'еть', 'ть', 'ешь', 'ет', 'ют', 'ут',
+    'ит', 'ат', 'ят', 'ишь', 'ли', 'ла', 'ло', 'а', 'я', 'о', 'е', 'и',
+    'ы', 'у', 'ю', 'ь', 'й'), key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+# literal, so the GIN index expression can be rendered in DDL
+SEARCH_CONFIG = text("'russian'")
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+HEADLINE_OPTIONS = (f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, '
+                    'MaxWords=25, MinWords=10')
+# found ids with highlighted snippets and total amount of hits
+SearchResult = tuple[list[tuple[int, Markup | None]], int]
+
+dead_letter_logger = logging.getLogger('search.dead_letter')
+
+
+def _document(model: Any) -> dict[str, Any]:
+    """Return searchable fields of a model."""
+    return {field: getattr(model, field) for field in model.__searchable__}
+
+
+def rebuild_index(index: str, model: Any) -> str | None:
+    """Build a new version of an index and point its alias to it.
+
+    Rows are streamed from the database and sent in bulk chunks,
+    so neither side holds the whole table in memory.
+    Return name of the new versioned index.
+    """
+    client = current_app.elasticsearch
+    if not client:
+        return None
+    chunk_size = current_app.config['SEARCH_BULK_CHUNK_SIZE']
+    version = f'{index}-{time.time_ns()}'
+    client.indices.create(index=version)
+    query = select(model).options(
+        *[undefer(getattr(model, field)) for field in model.__searchable__]
+    ).execution_options(yield_per=chunk_size)
+    try:
+        helpers.bulk(client,
+                     ({'_index': version,
+                       '_id': obj.id,
+                       '_source': _document(obj)}
+                      for obj in db.session.scalars(query)),
+                     chunk_size=chunk_size)
+    except Exception:
+        client.indices.delete(index=version)
+        raise
+
+    actions = [{'add': {'index': version, 'alias': index}}]
+    old_versions = []
+    if client.indices.exists_alias(name=index):
+        old_versions = list(client.indices.get_alias(name=index))
+        actions += [{'remove': {'index': old, 'alias': index}}
+                    for old in old_versions]
+    elif client.indices.exists(index=index):
+        # index created before aliases were used
+        actions.append({'remove_index': {'index': index}})
+    client.indices.update_aliases(actions=actions)
+    invalidate_search(index)
+    if old_versions:
+        client.indices.delete(index=','.join(old_versions))
+    return version
+
+
+def stem(word: str) -> str:
+    """Return a Russian word without its inflectional ending."""
+    for ending in ('ся', 'сь'):
+        if word.endswith(ending) and \
+                len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and \
+                len(word) - len(ending) >= MIN_STEM_LENGTH:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize_query(query: str) -> str:
+    """Return a query as case-folded stems separated by single spaces."""
+    words = re.findall(r'\w+', query.casefold().replace('ё', 'е'))
+    return ' '.join(stem(word) for word in words)
+
+
+def count_search(hit: bool) -> None:
+    """Count a search answered from the cache or from Elasticsearch."""
+    cache.cache.inc(SEARCH_STATS_KEY.format('hits' if hit else 'misses'))
+
 
-def add_to_index(index: int, model: Any) -> None:
-    """Add a new index to Elasticsearch."""
+def search_stats() -> dict[str, int | float]:
+    """Return amounts of cache hits and misses of the search."""
+    hits, misses = (value or 0 for value in cache.get_many(
+        SEARCH_STATS_KEY.format('hits'), SEARCH_STATS_KEY.format('misses')))
+    total = hits + misses
+    return {'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / total, 3) if total else 0}
+
+
+def invalidate_search(*indexes: str) -> None:
+    """Make cached result pages of the indexes outdated."""
+    invalidate_tags(*[SEARCH_TAG.format(index) for index in indexes])
+
+
+def _redis() -> redis.Redis:
+    """Return Redis client keeping the queue of index changes."""
+    if 'search_redis' not in current_app.extensions:
+        current_app.extensions['search_redis'] = redis.Redis.from_url(
+            current_app.config['CACHE_REDIS_URL'])
+    return current_app.extensions['search_redis']
+
+
+def queue_index(changes: Iterable[tuple[str, int]]) -> None:
+    """Queue changed documents and schedule flushing them.
+
+    Repeated changes of the same document are stored once,
+    so a burst of commits produces a single bulk request.
+    """
     if not current_app.elasticsearch:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    members = {f'{index}:{id}' for index, id in changes}
+    if not members:
+        return
+    try:
+        _redis().sadd(PENDING_KEY, *members)
+        flush_index_queue.apply_async(
+            countdown=current_app.config['SEARCH_FLUSH_DELAY'])
+    except (redis.exceptions.RedisError, kombu.exceptions.OperationalError):
+        current_app.logger.exception('Search index changes are not queued')
+
+
+def _take_pending() -> list[str]:
+    """Return and clear queued documents in one transaction."""
+    pipe = _redis().pipeline()
+    pipe.smembers(PENDING_KEY)
+    pipe.delete(PENDING_KEY)
+    members, _ = pipe.execute()
+    return sorted(member.decode() for member in members)
+
+
+def _searchable_model(index: str) -> Any:
+    """Return searchable model class stored in the given index."""
+    for mapper in db.Model.registry.mappers:
+        model = mapper.class_
+        if model.__tablename__ == index and hasattr(model, '__searchable__'):
+            return model
+    return None
+
+
+def _bulk_actions(members: list[str]) -> list[dict[str, Any]]:
+    """Return bulk actions reflecting current state of the database.
 
+    A document is indexed if its row exists and deleted otherwise,
+    so the order in which queued changes are flushed does not matter.
+    """
+    ids = defaultdict(set)
+    for member in members:
+        index, id = member.rsplit(':', 1)
+        ids[index].add(int(id))
+    actions = []
+    for index, index_ids in ids.items():
+        model = _searchable_model(index)
+        if model is None:
+            dead_letter_logger.error('Unknown search index %s', index)
+            continue
+        query = select(model).where(model.id.in_(index_ids)).options(
+            *[undefer(getattr(model, field))
+              for field in model.__searchable__])
+        for obj in db.session.scalars(query):
+            index_ids.discard(obj.id)
+            actions.append({'_op_type': 'index',
+                            '_index': index,
+                            '_id': obj.id,
+                            '_source': _document(obj)})
+        actions.extend({'_op_type': 'delete', '_index': index, '_id': id}
+                       for id in index_ids)
+    return actions
 
-def remove_from_index(index: int, model: Any) -> None:
-    """Remove a chosen index from Elasticsearch."""
+
+@shared_task(bind=True, ignore_result=True, max_retries=None)
+def flush_index_queue(self, members: list[str] | None = None) -> None:
+    """Send queued changes to Elasticsearch with the bulk API.
+
+    The whole batch is retried while the cluster is unreachable,
+    rejected documents are written to the dead-letter log.
+    """
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    if members is None:
+        members = _take_pending()
+    if not members:
+        return
+    try:
+        _, errors = helpers.bulk(current_app.elasticsearch,
+                                 _bulk_actions(members),
+                                 raise_on_error=False,
+                                 ignore_status=404)
+    except (elastic_transport.TransportError,
+            elasticsearch.ApiError) as error:
+        if self.request.retries < current_app.config['SEARCH_MAX_RETRIES']:
+            delay = current_app.config['SEARCH_RETRY_DELAY']
+            raise self.retry(
+                exc=error,
+                kwargs={'members': members},
+                countdown=delay * 2 ** self.request.retries)
+        dead_letter_logger.error(
+            'Search index changes are dropped: %s (%s)',
+            ', '.join(members), error)
+        return
+    invalidate_search(*{member.rsplit(':', 1)[0] for member in members})
+    for error in errors:
+        dead_letter_logger.error('Search document is rejected: %s', error)
+
+
+def _snippet(fragment: str) -> Markup:
+    """Return highlighted fragment as safe HTML without source markup."""
+    fragment = re.sub(r'^[^<]*?>|<[^>]*$', '', fragment)
+    fragment = re.sub(r'<.*?>|&\w+;', ' ', fragment)
+    return Markup(str(escape(' '.join(fragment.split()))).replace(
+        HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
 
 
 def query_index(index: int,
                 query,
                 page: int,
-                per_page: int) -> tuple[int, dict[str, str]]:
-    """Add query for chosen index."""
+                per_page: int) -> SearchResult:
+    """Return found ids with highlighted snippets and total amount."""
     if not current_app.elasticsearch:
         return [], 0
     search = current_app.elasticsearch.search(
         index=index,
         query={'multi_match': {'query': query, 'fields': ['*']}},
+        highlight={'fields': {'*': {}},
+                   'pre_tags': [HIGHLIGHT_START],
+                   'post_tags': [HIGHLIGHT_END],
+                   'fragment_size': EXCERPT_LENGTH,
+                   'number_of_fragments': 1},
+        source=False,
         from_=(page - 1) * per_page,
         size=per_page
     )
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    hits = []
+    for hit in search['hits']['hits']:
+        fragments = [fragment
+                     for field in hit.get('highlight', {}).values()
+                     for fragment in field]
+        hits.append((int(hit['_id']),
+                     _snippet(fragments[0]) if fragments else None))
+    return hits, search['hits']['total']['value']
+
+
+def search_document(model: Any) -> Any:
+    """Return SQL expression with all the searchable text of a model."""
+    fields = [getattr(model, field) for field in model.__searchable__]
+    if len(fields) == 1:
+        return fields[0]
+    return func.concat_ws(' ', *fields)
+
+
+def search_vector(model: Any) -> Any:
+    """Return tsvector expression covered by the GIN index of a model."""
+    return to_tsvector(SEARCH_CONFIG, search_document(model))
+
+
+class SearchBackend(ABC):
+    """Class for a way of full-text search over searchable models."""
+
+    def available(self) -> bool:
+        """Check whether the backend can be used now."""
+        return True
+
+    @abstractmethod
+    def search(self,
+               model: Any,
+               query: str,
+               page: int,
+               per_page: int) -> SearchResult:
+        """Return found ids with highlighted snippets and total amount."""
+
+
+class ElasticsearchBackend(SearchBackend):
+    """Class for search in the Elasticsearch cluster."""
+
+    def available(self) -> bool:
+        """Check whether Elasticsearch is configured."""
+        return current_app.elasticsearch is not None
+
+    def search(self, model, query, page, per_page):
+        """Search in the index of a model."""
+        return query_index(model.__tablename__, query, page, per_page)
+
+
+class DatabaseBackend(SearchBackend):
+    """Class for search in the database itself.
+
+    PostgreSQL matches a tsvector with the Russian configuration
+    using the GIN index, other databases fall back to ILIKE.
+    """
+
+    def search(self, model, query, page, per_page):
+        """Search in the table of a model."""
+        if db.session.get_bind().dialect.name == 'postgresql':
+            return self._full_text(model, query, page, per_page)
+        return self._like(model, query, page, per_page)
+
+    @staticmethod
+    def _full_text(model, query, page, per_page):
+        """Search by tsvector ranked with ts_rank."""
+        tsquery = websearch_to_tsquery(SEARCH_CONFIG, query)
+        vector = search_vector(model)
+        condition = vector.op('@@')(tsquery)
+        total = db.session.scalar(
+            select(func.count()).select_from(model).where(condition))
+        if not total:
+            return [], 0
+        rows = db.session.execute(
+            select(model.id,
+                   ts_headline(SEARCH_CONFIG, search_document(model),
+                               tsquery, HEADLINE_OPTIONS)).where(
+                condition).order_by(
+                func.ts_rank(vector, tsquery).desc(), model.id).offset(
+                (page - 1) * per_page).limit(per_page))
+        return [(id, _snippet(headline)) for id, headline in rows], total
+
+    @staticmethod
+    def _like(model, query, page, per_page):
+        """Search rows containing every word of a query."""
+        words = [re.sub(r'([\\%_])', r'\\\1', word)
+                 for word in query.split()]
+        if not words:
+            return [], 0
+        condition = and_(*[
+            or_(*[getattr(model, field).ilike(f'%{word}%', escape='\\')
+                  for field in model.__searchable__])
+            for word in words])
+        total = db.session.scalar(
+            select(func.count()).select_from(model).where(condition))
+        ids = db.session.scalars(
+            select(model.id).where(condition).order_by(model.id).offset(
+                (page - 1) * per_page).limit(per_page))
+        return [(id, None) for id in ids], total
+
+
+SEARCH_BACKENDS = {'elasticsearch': ElasticsearchBackend,
+                   'database': DatabaseBackend}
+
+
+def full_text_search(model: Any,
+                     query: str,
+                     page: int,
+                     per_page: int) -> SearchResult:
+    """Search with the configured backend falling back to the database."""
+    backend = SEARCH_BACKENDS[current_app.config['SEARCH_BACKEND']]()
+    if not backend.available():
+        backend = DatabaseBackend()
+    try:
+        return backend.search(model, query, page, per_page)
+    except (elastic_transport.TransportError, elasticsearch.ApiError):
+        current_app.logger.exception('Search falls back to the database')
+        return DatabaseBackend().search(model, query, page, per_page)
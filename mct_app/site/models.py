@@ -1,77 +1,226 @@
 from datetime import datetime
-from typing import List
+import glob
+import os
+import re
+from typing import List, Optional
 
-import elastic_transport
 from flask import current_app
-from sqlalchemy import (DateTime, ForeignKey, Integer,
-                        select, String, Text, UnicodeText)
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import (DateTime, delete, ForeignKey, func, Index,
+                        insert, inspect, Integer, JSON, Select, select,
+                        String, Text, UnicodeText, update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (Mapped, mapped_column, object_session,
+                            relationship)
 
-from mct_app import db
-from mct_app.search import add_to_index, query_index, remove_from_index
+from config import EXCERPT_LENGTH, FILE_BASE_PATH, FILE_REL_PATH
+from mct_app import cache, db
+from mct_app.caching import tags_version
+from mct_app.search import (count_search, full_text_search,
+                            normalize_query, queue_index, rebuild_index,
+                            SEARCH_CACHE_KEY, SEARCH_TAG, search_vector)
+
+
+RELEASED_IMAGES = 'released_images'
+SEARCH_CHANGES = 'search_changes'
 
 
 class SearchableMixin:
     """Class for mixin to use Elasticsearch."""
 
+    __search_columns__ = ('id',)
+
     @classmethod
     def search(cls, expression, page, per_page):
-        """Search some full text in Elasticsearch."""
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return [], 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        query = select(cls).where(cls.id.in_(ids)).order_by(
-            db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
+        """Search some full text with the configured search backend.
+
+        Return dictionaries of search columns with highlighted snippets,
+        pages of results are cached for a short time.
+        """
+        key = SEARCH_CACHE_KEY.format(
+            cls.__tablename__,
+            tags_version(SEARCH_TAG.format(cls.__tablename__)),
+            normalize_query(expression),
+            page)
+        cached = cache.get(key)
+        count_search(cached is not None)
+        if cached is not None:
+            return cached
+        hits, total = full_text_search(cls, expression, page, per_page)
+        results = []
+        if hits:
+            rows = db.session.execute(
+                select(*[getattr(cls, column)
+                         for column in cls.__search_columns__]).where(
+                    cls.id.in_([id for id, _ in hits])))
+            found = {row.id: row._asdict() for row in rows}
+            results = [found[id] | {'snippet': snippet}
+                       for id, snippet in hits if id in found]
+        cache.set(key, (results, total),
+                  timeout=current_app.config['SEARCH_CACHE_TIMEOUT'])
+        return results, total
 
     @classmethod
-    def before_commit(cls, session):
-        """Choose action working with Elasticsearch."""
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def collect_changes(cls, session, flush_context) -> None:
+        """Remember searchable objects written by a flush.
+
+        Objects are collected on every flush, because a commit
+        in the middle of a request leaves nothing dirty for the last one.
+        """
+        session.info.setdefault(SEARCH_CHANGES, set()).update(
+            (obj.__tablename__, obj.id)
+            for obj in (*session.new, *session.dirty, *session.deleted)
+            if isinstance(obj, SearchableMixin))
 
     @classmethod
     def after_commit(cls, session):
-        """Do automatically some action after commit."""
-        try:
-            for obj in session._changes['add']:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(obj.__tablename__, obj)
-            for obj in session._changes['update']:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(obj.__tablename__, obj)
-            for obj in session._changes['delete']:
-                if isinstance(obj, SearchableMixin):
-                    remove_from_index(obj.__tablename__, obj)
-            session._changes = None
-        except elastic_transport.ConnectionError:
-            current_app.logger.exception('Elasticsearch server doesnt work')
+        """Queue changed objects for indexing in Elasticsearch."""
+        changes = session.info.pop(SEARCH_CHANGES, None)
+        if changes:
+            queue_index(changes)
+
+    @classmethod
+    def forget_changes(cls, session, previous_transaction=None) -> None:
+        """Do not index objects of a rolled back transaction."""
+        session.info.pop(SEARCH_CHANGES, None)
 
     @classmethod
     def reindex(cls):
         """Reindex all the indecies in Elasticsearch."""
-        for obj in db.session.scalars(select(cls)):
-            add_to_index(cls.__tablename__, obj)
+        return rebuild_index(cls.__tablename__, cls)
+
+
+class ExcerptMixin:
+    """Class for mixin storing a short excerpt of a large text column.
+
+    The large column is deferred, so list pages show the excerpt
+    and load the full text only on detail pages.
+    """
+
+    __excerpt_source__ = None
+
+    excerpt: Mapped[Optional[str]] = mapped_column(
+        String(EXCERPT_LENGTH), nullable=True)
+
+    @staticmethod
+    def make_excerpt(text: str | None) -> str | None:
+        """Return beginning of a text without HTML tags."""
+        if text is None:
+            return None
+        text = re.sub(r'<.*?>|&\w+;', ' ', text)
+        return ' '.join(text.split())[:EXCERPT_LENGTH]
+
+    @staticmethod
+    def update_excerpt(mapper, connection, target) -> None:
+        """Refresh excerpt before saving if the large column changed."""
+        source = target.__excerpt_source__
+        if inspect(target).attrs[source].history.has_changes():
+            target.excerpt = target.make_excerpt(getattr(target, source))
+
+
+class ContentCounter(db.Model):
+    """Class for maintained amounts of rows shown in paginated feeds."""
+
+    __tablename__ = 'content_counters'
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    value: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name: str, query: Select) -> int:
+        """Return value of a counter, counting the query if it is absent.
+
+        A missing counter is created on a separate connection,
+        so the session of the request is never committed.
+        """
+        value = db.session.scalar(
+            select(ContentCounter.value).where(ContentCounter.name == name))
+        if value is not None:
+            return value
+        value = db.session.scalar(
+            select(func.count()).select_from(
+                query.order_by(None).subquery()))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(ContentCounter).values(
+                    name=name, value=value))
+        except IntegrityError:
+            # another request has just created the same counter
+            pass
+        return value
+
+    @staticmethod
+    def recompute() -> dict[str, int]:
+        """Count rows of all the counted models from scratch."""
+        counters = {}
+        for model in CountedMixin.__subclasses__():
+            columns = [getattr(model, name) for name in model.__counter_by__]
+            query = select(*columns, func.count()).select_from(model)
+            if columns:
+                query = query.group_by(*columns)
+            for *values, value in db.session.execute(query):
+                name = model.__counter__.format(
+                    **dict(zip(model.__counter_by__, values)))
+                counters[name] = value
+        db.session.execute(delete(ContentCounter))
+        db.session.add_all([ContentCounter(name=name, value=value)
+                            for name, value in counters.items()])
+        db.session.commit()
+        return counters
+
+
+class CountedMixin:
+    """Class for mixin keeping amount of rows in ContentCounter.
+
+    __counter__ is a name of the counter which may be formatted
+    with columns listed in __counter_by__, e.g. 'diary/{user_id}'.
+    """
+
+    __counter__ = None
+    __counter_by__ = ()
+
+    @classmethod
+    def counter_name(cls, target) -> str:
+        """Return name of the counter of a particular row."""
+        return cls.__counter__.format(
+            **{name: getattr(target, name) for name in cls.__counter_by__})
+
+    @staticmethod
+    def increment(mapper, connection, target) -> None:
+        """Add an inserted row to its counter."""
+        connection.execute(update(ContentCounter).where(
+            ContentCounter.name == target.counter_name(target)).values(
+                value=ContentCounter.value + 1))
+
+    @staticmethod
+    def decrement(mapper, connection, target) -> None:
+        """Remove a deleted row from its counter."""
+        connection.execute(update(ContentCounter).where(
+            ContentCounter.name == target.counter_name(target)).values(
+                value=ContentCounter.value - 1))
 
 
 class Image(db.Model):
-    """Class for image model."""
+    """Class for image model.
+
+    Uploaded files are named by a hash of their content, so every file
+    has a single row counting references of news, article cards,
+    articles and paragraphs to it.
+    """
 
     __tablename__ = 'image'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    filename: Mapped[str] = mapped_column(String(255))
+    filename: Mapped[str] = mapped_column(String(255), unique=True)
     absolute_path: Mapped[str] = mapped_column(String(255))
     relative_path: Mapped[str] = mapped_column(String(255))
+    # widths of responsive variants, the last one is the full image
+    widths: Mapped[Optional[list[int]]] = mapped_column(JSON, nullable=True)
+    ref_count: Mapped[int] = mapped_column(
+        Integer, default=0, server_default='0')
 
-    news: Mapped['News'] = relationship(back_populates='image')
-    article_card: Mapped['ArticleCard'] = relationship(back_populates='image')
+    news: Mapped[List['News']] = relationship(back_populates='image')
+    article_cards: Mapped[List['ArticleCard']] = relationship(
+        back_populates='image')
     articles: Mapped[List['ArticleImage']] = relationship(
         back_populates='image')
     textbook_paragraphs: Mapped[List['TextbookParagraphImage']] = relationship(
@@ -81,11 +230,110 @@ class Image(db.Model):
         """Show an image's filename in the terminal."""
         return f'{self.__class__.__name__}(file={self.filename})'
 
-
-class ArticleCard(db.Model):
+    @staticmethod
+    def for_file(filename: str,
+                 widths: list[int] | None = None) -> 'Image':
+        """Return image of a file creating it on the first reference.
+
+        Widths of responsive variants are stored with a new image.
+        """
+        for obj in db.session.new:
+            if isinstance(obj, Image) and obj.filename == filename:
+                return obj
+        with db.session.no_autoflush:
+            image = db.session.scalar(
+                select(Image).where(Image.filename == filename))
+        if image is None:
+            image = Image(
+                filename=filename,
+                absolute_path=os.path.join(FILE_BASE_PATH, filename),
+                relative_path=os.path.join(FILE_REL_PATH, filename),
+                widths=widths)
+            db.session.add(image)
+        return image
+
+    @staticmethod
+    def change_refs(connection, image_id: int | None, delta: int) -> None:
+        """Add a delta to the reference count of an image."""
+        if image_id is None:
+            return
+        connection.execute(update(Image).where(Image.id == image_id).values(
+            ref_count=Image.ref_count + delta))
+
+    @staticmethod
+    def remove_files(filename: str) -> None:
+        """Remove a file of an image with all its responsive variants."""
+        path = os.path.join(FILE_BASE_PATH, filename)
+        stem, extension = os.path.splitext(path)
+        for file in [path, *glob.glob(f'{glob.escape(stem)}-*w{extension}')]:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def purge_released(session) -> None:
+        """Delete released images nobody refers to along with files."""
+        image_ids = session.info.pop(RELEASED_IMAGES, None)
+        if not image_ids:
+            return
+        with db.engine.begin() as connection:
+            filenames = connection.scalars(
+                delete(Image).where(Image.id.in_(image_ids),
+                                    Image.ref_count <= 0).returning(
+                    Image.filename)).all()
+        for filename in filenames:
+            Image.remove_files(filename)
+
+    @staticmethod
+    def forget_released(session, previous_transaction=None) -> None:
+        """Keep released images when their release is rolled back."""
+        session.info.pop(RELEASED_IMAGES, None)
+
+
+class ImageRefMixin:
+    """Class for mixin of a model referring to an image by image_id."""
+
+    @staticmethod
+    def _release(target, image_id: int | None) -> None:
+        """Remember an image to be purged if it is not referred anymore."""
+        if image_id is not None:
+            object_session(target).info.setdefault(
+                RELEASED_IMAGES, set()).add(image_id)
+
+    @staticmethod
+    def add_ref(mapper, connection, target) -> None:
+        """Count a reference of an inserted row."""
+        Image.change_refs(connection, target.image_id, 1)
+
+    @staticmethod
+    def remove_ref(mapper, connection, target) -> None:
+        """Release an image of a deleted row."""
+        Image.change_refs(connection, target.image_id, -1)
+        ImageRefMixin._release(target, target.image_id)
+
+    @staticmethod
+    def move_ref(mapper, connection, target) -> None:
+        """Move a reference of a row which gets another image."""
+        if not inspect(target).attrs.image_id.history.has_changes():
+            return
+        # the previous value may be expired, so it is read from the table
+        old_id = connection.scalar(
+            select(mapper.local_table.c.image_id).where(*[
+                column == value for column, value in zip(
+                    mapper.primary_key, inspect(target).identity)]))
+        if old_id == target.image_id:
+            return
+        Image.change_refs(connection, old_id, -1)
+        ImageRefMixin._release(target, old_id)
+        Image.change_refs(connection, target.image_id, 1)
+
+
+class ArticleCard(ImageRefMixin, CountedMixin, db.Model):
     """Class for an article card."""
 
     __tablename__ = 'article_card'
+    __counter__ = 'articles'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(255))
@@ -96,20 +344,20 @@ class ArticleCard(db.Model):
     article_id: Mapped[int] = mapped_column(
         ForeignKey('article.id', ondelete='CASCADE'))
 
-    image: Mapped['Image'] = relationship(
-        back_populates='article_card', cascade='all, delete')
+    image: Mapped['Image'] = relationship(back_populates='article_cards')
     article: Mapped['Article'] = relationship(
         back_populates='article_card', cascade='all, delete')
 
 
-class Article(db.Model):
+class Article(ExcerptMixin, db.Model):
     """Class for a single article."""
 
     __tablename__ = 'article'
+    __excerpt_source__ = 'body'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(255))
-    body: Mapped[str] = mapped_column(UnicodeText)
+    body: Mapped[str] = mapped_column(UnicodeText, deferred=True)
 
     article_card: Mapped['ArticleCard'] = relationship(
         back_populates='article')
@@ -121,7 +369,7 @@ class Article(db.Model):
         return f'{self.__class__.__name__} - {self.body}'
 
 
-class ArticleImage(db.Model):
+class ArticleImage(ImageRefMixin, db.Model):
     """Class for intermediate table between Article and Image."""
 
     __tablename__ = 'article_image'
@@ -132,24 +380,24 @@ class ArticleImage(db.Model):
         ForeignKey('image.id', ondelete='CASCADE'), primary_key=True)
 
     article: Mapped['Article'] = relationship(back_populates='images')
-    image: Mapped['Image'] = relationship(
-        back_populates='articles', cascade='all, delete')
+    image: Mapped['Image'] = relationship(back_populates='articles')
 
 
-class News(db.Model):
+class News(ImageRefMixin, CountedMixin, ExcerptMixin, db.Model):
     """Class for news."""
 
     __tablename__ = 'news'
+    __counter__ = 'news'
+    __excerpt_source__ = 'content'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     title: Mapped[str] = mapped_column(String(255))
-    content: Mapped[str] = mapped_column(Text)
+    content: Mapped[str] = mapped_column(Text, deferred=True)
     last_update: Mapped[datetime] = mapped_column(DateTime, index=True)
     image_id: Mapped[int] = mapped_column(
         ForeignKey('image.id', ondelete='CASCADE'))
 
-    image: Mapped['Image'] = relationship(
-        back_populates='news', cascade='all, delete')
+    image: Mapped['Image'] = relationship(back_populates='news')
 
 
 class TextbookChapter(db.Model):
@@ -169,15 +417,17 @@ class TextbookChapter(db.Model):
         return f'{self.__class__.__name__}({self.name})'
 
 
-class TextbookParagraph(SearchableMixin, db.Model):
+class TextbookParagraph(SearchableMixin, ExcerptMixin, db.Model):
     """Class for a textbook paragraph."""
 
     __tablename__ = 'textbook_paragraph'
     __searchable__ = ['content']
+    __search_columns__ = ('id', 'name', 'excerpt')
+    __excerpt_source__ = 'content'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(100), nullable=False, index=True)
-    content: Mapped[str] = mapped_column(UnicodeText)
+    content: Mapped[str] = mapped_column(UnicodeText, deferred=True)
     textbook_chapter_id: Mapped[int] = mapped_column(
         ForeignKey('textbook_chapter.id', ondelete='SET NULL'), nullable=True)
 
@@ -191,7 +441,12 @@ class TextbookParagraph(SearchableMixin, db.Model):
         return f'{self.__class__.__name__}({self.name})'
 
 
-class TextbookParagraphImage(db.Model):
+Index('ix_textbook_paragraph_search',
+      search_vector(TextbookParagraph),
+      postgresql_using='gin').ddl_if(dialect='postgresql')
+
+
+class TextbookParagraphImage(ImageRefMixin, db.Model):
     """Class for intermediate table between TextbooParagraph and Image."""
 
     __tablename__ = 'textbook_paragraph_image'
@@ -203,10 +458,28 @@ class TextbookParagraphImage(db.Model):
         primary_key=True)
 
     image: Mapped['Image'] = relationship(
-        back_populates='textbook_paragraphs', cascade='all, delete')
+        back_populates='textbook_paragraphs')
     textbook_paragraph: Mapped['TextbookParagraph'] = relationship(
         back_populates='images')
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.collect_changes)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(
+    db.session, 'after_soft_rollback', SearchableMixin.forget_changes)
+db.event.listen(
+    ExcerptMixin, 'before_insert', ExcerptMixin.update_excerpt, propagate=True)
+db.event.listen(
+    CountedMixin, 'after_insert', CountedMixin.increment, propagate=True)
+db.event.listen(
+    CountedMixin, 'after_delete', CountedMixin.decrement, propagate=True)
+db.event.listen(
+    ExcerptMixin, 'before_update', ExcerptMixin.update_excerpt, propagate=True)
+db.event.listen(
+    ImageRefMixin, 'after_insert', ImageRefMixin.add_ref, propagate=True)
+db.event.listen(
+    ImageRefMixin, 'before_update', ImageRefMixin.move_ref, propagate=True)
+db.event.listen(
+    ImageRefMixin, 'after_delete', ImageRefMixin.remove_ref, propagate=True)
+db.event.listen(db.session, 'after_commit', Image.purge_released)
+db.event.listen(db.session, 'after_soft_rollback', Image.forget_released)
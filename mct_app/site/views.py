@@ -1,9 +1,7 @@
 from datetime import datetime
-import json
 import os
 
 
-import elasticsearch
 from flask import (abort, Blueprint,
                    current_app, flash,
                    g, redirect,
@@ -13,20 +11,26 @@ from flask_login import current_user
 import kombu
 import pytz
 import requests
-from sqlalchemy import select
+from sqlalchemy import func, select
+from sqlalchemy.orm import (joinedload, load_only, selectinload,
+                            undefer, with_expression)
 import werkzeug.exceptions
 
 
-from config import SOICAL_MEDIA_LINKS
+from config import ContentType, SOICAL_MEDIA_LINKS
 from mct_app import cache, csrf, db
-from mct_app.auth.models import Answer, Consultation, Question, UserStatistics
+from mct_app.caching import tagged_cache_key, user_cache_key
+from mct_app.auth.models import (Answer, Consultation,
+                                 Question, ReadingProgress, User)
 from mct_app.email import send_email
+from mct_app.pagination import keyset_paginate
 from mct_app.site.forms import (AnswerForm, ConsultationForm,
                                 QuestionForm, SearchForm)
 from mct_app.site.models import (Article, ArticleCard,
                                  News, TextbookChapter,
                                  TextbookParagraph)
-from mct_app.utils import create_articles_dictionary_by_month
+from mct_app.utils import (create_articles_dictionary_by_month,
+                           mark_read_paragraphs)
 
 
 GOOGLE_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
@@ -89,7 +93,9 @@ def base_template_data_processor() -> dict[str, str]:
     }
 
 
-@cache.cached(timeout=60, key_prefix='articles_list')
+@cache.cached(
+    timeout=60,
+    key_prefix=tagged_cache_key('articles', key='articles_list'))
 def create_articles_list():
     """Create dictionary of months and articles."""
     articles_by_month_list = db.session.query(
@@ -101,7 +107,7 @@ def create_articles_list():
 
 @site.route('/')
 @site.route('/home')
-@cache.cached(timeout=30)
+@cache.cached(timeout=30, key_prefix=user_cache_key)
 def home():
     """Render a home page."""
     return render_template('home.html')
@@ -109,51 +115,45 @@ def home():
 
 @site.route('/search')
 def search():
-    """Allow to invoke a full-text search by Elasticsearch."""
+    """Allow to invoke a full-text search."""
     if not g.search_form.validate():
         return redirect(url_for('site.home'))
-    try:
-        page = request.args.get('page', 1, type=int)
-        paragraphs, total = TextbookParagraph.search(
-            g.search_form.q.data,
-            page,
-            SEARCH_RESULTS_PER_PAGE
-        )
-        next_url = url_for(
-            'site.search',
-            q=g.search_form.q.data,
-            page=page + 1) if total > page * SEARCH_RESULTS_PER_PAGE else None
-        prev_url = url_for(
-            'site.search',
-            q=g.search_form.q.data,
-            page=page - 1) if page > 1 else None
-        return render_template(
-            'search_result.html',
-            title='Результаты поиска',
-            paragraphs=paragraphs,
-            next_url=next_url,
-            prev_url=prev_url)
-    except elasticsearch.NotFoundError:
-        current_app.logger.exception('Paragrapth has no Elasticsearch')
-        return redirect(url_for('site.home'))
+    page = request.args.get('page', 1, type=int)
+    paragraphs, total = TextbookParagraph.search(
+        g.search_form.q.data,
+        page,
+        SEARCH_RESULTS_PER_PAGE
+    )
+    next_url = url_for(
+        'site.search',
+        q=g.search_form.q.data,
+        page=page + 1) if total > page * SEARCH_RESULTS_PER_PAGE else None
+    prev_url = url_for(
+        'site.search',
+        q=g.search_form.q.data,
+        page=page - 1) if page > 1 else None
+    return render_template(
+        'search_result.html',
+        title='Результаты поиска',
+        paragraphs=paragraphs,
+        next_url=next_url,
+        prev_url=prev_url)
 
 
 @site.route('/news')
 def news():
     """Render news page."""
     flash('news', 'active_links')
-    query = select(News).order_by(News.last_update.desc())
-    page = request.args.get('page', 1, type=int)
-    news = db.paginate(
-        query,
-        page=page,
-        per_page=NEWS_PER_PAGE,
-        error_out=False)
+    query = select(News).options(undefer(News.content))
+    news = keyset_paginate(
+        query, News.last_update, News.id, NEWS_PER_PAGE, 'news')
     pages_amount = news.pages
     active_page = news.page
     current_site = 'site.news'
-    next_url = url_for(current_site, page=news.next_num) if news.has_next else None
-    prev_url = url_for(current_site, page=news.prev_num) if news.has_prev else None
+    next_url = url_for(current_site, cursor=news.next_cursor) \
+        if news.has_next else None
+    prev_url = url_for(current_site, cursor=news.prev_cursor) \
+        if news.has_prev else None
     
     data = {'news': news.items,
             'next_url': next_url,
@@ -171,21 +171,20 @@ def articles():
     """Render list of articles cards."""
     flash('articles', 'active_links')
 
-    query = select(ArticleCard).order_by(ArticleCard.last_update.desc())
-    page = request.args.get('page', 1, type=int)
-    articles = db.paginate(
-        query,
-        page=page,
-        per_page=ARTICLES_PER_PAGE,
-        error_out=False)
+    articles = keyset_paginate(
+        select(ArticleCard),
+        ArticleCard.last_update,
+        ArticleCard.id,
+        ARTICLES_PER_PAGE,
+        'articles')
     pages_amount = articles.pages
     active_page = articles.page
     next_url = url_for(
         'site.articles',
-        page=articles.next_num) if articles.has_next else None
+        cursor=articles.next_cursor) if articles.has_next else None
     prev_url = url_for(
         'site.articles',
-        page=articles.prev_num) if articles.has_prev else None
+        cursor=articles.prev_cursor) if articles.has_prev else None
     current_site = 'site.articles'
 
     data = {'articles': articles.items,
@@ -198,76 +197,90 @@ def articles():
     return render_template('articles.html', data=data)
 
 
-@site.route('/articles/<article_id>', methods=['GET', 'POST'])
-def article(article_id, has_read=False, statisticts_dict=None):
+@site.route('/articles/<int:article_id>', methods=['GET', 'POST'])
+def article(article_id, has_read=False, read_ids=None):
     """Render chosen article."""
     if current_user.is_authenticated:
-        statistics_instance = UserStatistics.query.filter_by(
-            user_id=current_user.id).first()
-        statisticts_dict = json.loads(statistics_instance.articles_statistics)
-        has_read = statisticts_dict[article_id]
         if request.form.get('has_read'):
-            has_read = not has_read
-            statisticts_dict[article_id] = has_read
-            statistics_instance.articles_statistics = json.dumps(
-                statisticts_dict)
-            db.session.commit()
+            ReadingProgress.toggle(
+                current_user.id, ContentType.ARTICLE, article_id)
+        read_ids = ReadingProgress.read_ids(
+            current_user.id, ContentType.ARTICLE)
+        has_read = article_id in read_ids
     articles_by_month = create_articles_list()
-    article = Article.query.filter_by(id=article_id).first()
+    article = Article.query.options(undefer(Article.body)).filter_by(
+        id=article_id).first()
 
     data = {'article': article,
             'articles_by_month': articles_by_month,
             'has_read': has_read,
-            'statisticts_dict': statisticts_dict}
+            'read_ids': read_ids}
 
     return render_template('article.html', data=data)
 
 
+@cache.cached(
+    timeout=86400,
+    key_prefix=tagged_cache_key('textbook', key='textbook_tree'))
+def render_textbook_tree():
+    """Render chapters and paragraphs of the textbook shared by everyone."""
+    textbook_data = db.session.scalars(
+        select(TextbookChapter).options(
+            selectinload(TextbookChapter.textbook_paragraphs))).all()
+    return render_template('textbook_tree.html', textbook_data=textbook_data)
+
+
 @site.route('/textbook')
-@cache.cached(timeout=40)
-def textbook(statisticts_dict=None):
+def textbook():
     """Render texbook chapters and paragraphs."""
     flash('textbook', 'active_links')
-    textbook_data = TextbookChapter.query.all()
+    read_ids = set()
     if current_user.is_authenticated:
-        statistics_instance = UserStatistics.query.filter_by(
-            user_id=current_user.id).first()
-        statisticts_dict = json.loads(statistics_instance.textbook_statistics)
+        read_ids = ReadingProgress.read_ids(
+            current_user.id, ContentType.TEXTBOOK_PARAGRAPH)
     return render_template(
         'textbook.html',
-        textbook_data=textbook_data,
-        statisticts_dict=statisticts_dict)
+        textbook_tree=mark_read_paragraphs(render_textbook_tree(), read_ids))
+
+
+@cache.cached(
+    timeout=86400,
+    key_prefix=tagged_cache_key('textbook', key='textbook_navigation'))
+def get_textbook_navigation():
+    """Return ordered ids and names of paragraphs with their positions."""
+    paragraphs = db.session.execute(
+        select(TextbookParagraph.id, TextbookParagraph.name).order_by(
+            TextbookParagraph.name)).all()
+    return {'paragraphs': [tuple(paragraph) for paragraph in paragraphs],
+            'positions': {name: position
+                          for position, (_, name) in enumerate(paragraphs)}}
 
 
 @site.route('/textbook/<paragraph>', methods=['GET', 'POST'])
 def textbook_paragraph(paragraph, has_read=None):
     """Render a particelar textbook paragraph."""
-    paragraph = TextbookParagraph.query.filter_by(
-        name=paragraph).first_or_404()
-    paragraphs = TextbookParagraph.query.order_by(TextbookParagraph.name).all()
-    current_index = next(
-        (index for index, par in enumerate(paragraphs) if par == paragraph),
-        None)
-    prev_index = current_index - 1 if current_index > 0 else None
-    next_index = current_index + 1 if current_index < len(paragraphs) - 1 \
-        else None
+    navigation = get_textbook_navigation()
+    position = navigation['positions'].get(paragraph)
+    if position is None:
+        abort(404)
+    paragraphs = navigation['paragraphs']
+    paragraph = TextbookParagraph.query.options(
+        undefer(TextbookParagraph.content)).get_or_404(
+            paragraphs[position][0])
+    prev_name = paragraphs[position - 1][1] if position > 0 else None
+    next_name = paragraphs[position + 1][1] \
+        if position < len(paragraphs) - 1 else None
     if current_user.is_authenticated:
-        statistics_instance = UserStatistics.query.filter_by(
-            user_id=current_user.id).first()
-        statisticts_dict = json.loads(statistics_instance.textbook_statistics)
-        has_read = statisticts_dict[str(paragraph.id)]
         if request.form.get('has_read'):
-            has_read = not has_read
-            statisticts_dict[str(paragraph.id)] = has_read
-            statistics_instance.textbook_statistics = json.dumps(
-                statisticts_dict)
-            cache.clear()
-            db.session.commit()
-    
+            has_read = ReadingProgress.toggle(
+                current_user.id, ContentType.TEXTBOOK_PARAGRAPH, paragraph.id)
+        else:
+            has_read = ReadingProgress.has_read(
+                current_user.id, ContentType.TEXTBOOK_PARAGRAPH, paragraph.id)
+
     data = {'paragraph': paragraph,
-            'paragraphs': paragraphs,
-            'prev_index': prev_index,
-            'next_index': next_index,
+            'prev_name': prev_name,
+            'next_name': next_name,
             'has_read': has_read}
 
     return render_template('paragraph.html', data=data)
@@ -299,18 +312,24 @@ def questions():
         db.session.commit()
         return redirect(url_for('site.question', question_id=question.id))
 
-    page = request.args.get('page', 1, type=int)
-    query = select(Question).order_by(Question.date.desc())
-    questions = db.paginate(query, page=page, per_page=QUESTIONS_PER_PAGE)
+    answers_count = select(func.count(Answer.id)).where(
+        Answer.question_id == Question.id).scalar_subquery()
+    query = select(Question).options(
+        load_only(Question.id, Question.anon_name,
+                  Question.date, Question.excerpt),
+        joinedload(Question.user).load_only(User.username),
+        with_expression(Question.answers_count, answers_count))
+    questions = keyset_paginate(
+        query, Question.date, Question.id, QUESTIONS_PER_PAGE, 'questions')
     pages_amount = questions.pages
     active_page = questions.page
     current_site = 'site.questions'
     next_url = url_for(
         'site.questions',
-        page=questions.next_num) if questions.has_next else None
+        cursor=questions.next_cursor) if questions.has_next else None
     prev_url = url_for(
         'site.questions',
-        page=questions.prev_num) if questions.has_prev else None
+        cursor=questions.prev_cursor) if questions.has_prev else None
     
     data = {'form': form,
             'site_key': site_key,
@@ -327,7 +346,11 @@ def questions():
 @site.route('/questions/<question_id>', methods=['GET', 'POST'])
 def question(question_id):
     """Render a particular question with answers."""
-    question = Question.query.filter_by(id=question_id).first()
+    question = Question.query.options(
+        undefer(Question.body),
+        joinedload(Question.user),
+        selectinload(Question.answers).selectinload(Answer.user)).filter_by(
+            id=question_id).first()
     form = AnswerForm()
     if form.validate_on_submit():
         answer = Answer(
@@ -388,7 +411,7 @@ def consultation():
 
 
 @site.route('/contacts')
-@cache.cached(timeout=86400)
+@cache.cached(timeout=86400, key_prefix=user_cache_key)
 def contacts():
     """Render contacts page."""
     flash('contacts', 'active_links')
@@ -396,7 +419,7 @@ def contacts():
 
 
 @site.route('/cookie-info')
-@cache.cached(timeout=86400)
+@cache.cached(timeout=86400, key_prefix=user_cache_key)
 def cookie_info():
     """Render cookie info page."""
     return render_template('cookie-info.html')
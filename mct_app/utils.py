@@ -1,14 +1,25 @@
+import glob
+import hashlib
+import ipaddress
+import os
 import re
-from typing import Dict, List, Literal
+from typing import Dict, List, Literal, Sequence, Set
 import uuid
 
-from flask import json
-from config import ALLOWED_RUS_SYMBOLS, BANNED_IP_FILE_PATH
-from mct_app.site.models import ArticleCard
+from celery import shared_task
+from flask import current_app, json
+from config import (ALLOWED_RUS_SYMBOLS, BANNED_IP_FILE_PATH,
+                    FILE_BASE_PATH, STAGING_PATH)
+from mct_app import cache, db
+from mct_app.site.models import ArticleCard, Image as MyImage
 from PIL import Image
+from sqlalchemy import select, update
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
+# errors of Pillow reading a broken or hostile image
+IMAGE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
 
 def get_images_names(text: str) -> List[str]:
     """Return all the images links from HTML body."""
@@ -21,6 +32,14 @@ def get_random_email() -> str:
     return f'{uuid.uuid4()}@metacognitive-therapy.ru'
 
 
+def mark_read_paragraphs(textbook_tree: str, read_ids: Set[int]) -> str:
+    """Put a check mark before every paragraph the user has read."""
+    return re.sub(
+        r'<!--read:(\d+)-->',
+        lambda match: '✅ ' if int(match.group(1)) in read_ids else '',
+        textbook_tree)
+
+
 def get_statistics_data(statistics: Dict[int, bool]) -> int:
     """Return percentage of content completion."""
     full_amount = len(statistics)
@@ -32,9 +51,15 @@ def get_statistics_data(statistics: Dict[int, bool]) -> int:
 
 
 def generate_image_name(obj=None, file_data=None) -> str:
-    """Generate a random picture name."""
-    image_suffix = uuid.uuid4()
-    return secure_filename(f"image_{image_suffix}")
+    """Generate a picture name from a hash of its content."""
+    if file_data is None:
+        return secure_filename(f"image_{uuid.uuid4()}")
+    digest = hashlib.sha256()
+    file_data.stream.seek(0)
+    for chunk in iter(lambda: file_data.stream.read(65536), b''):
+        digest.update(chunk)
+    file_data.stream.seek(0)
+    return f'image_{digest.hexdigest()}'
 
 
 def create_articles_dictionary_by_month(article_cards: List[ArticleCard]
@@ -52,40 +77,164 @@ def create_articles_dictionary_by_month(article_cards: List[ArticleCard]
     return acticles_by_month
 
 
+def fit_size(
+        width: int,
+        height: int,
+        max_width: int = 1280,
+        max_height: int = 720) -> tuple[int, int]:
+    """Return size of an image fitted into the maximum size."""
+    if width > max_width or height > max_height:
+        if width / max_width > height / max_height:
+            return max_width, round(height * (max_width / width))
+        return round(width * (max_height / height)), max_height
+    return width, height
+
+
 def resize_image(
         image: Image,
         max_width: int = 1280,
         max_height: int = 720) -> Image:
-    """Resize any uploading image to proper condition."""
-    width, height = image.size
-    if width > max_width or height > max_height:
-        if width / max_width > height / max_height:
-            new_width = max_width
-            new_height = int(height * (max_width / width))
-        else:
-            new_height = max_height
-            new_width = int(width * (max_height / height))
+    """Resize any uploading image to proper condition.
 
-        resized_image = image.resize((new_width, new_height))
-        return resized_image
+    A JPEG which is not loaded yet is decoded at a reduced scale
+    in draft mode, so a large photo is never held in memory
+    at full resolution. Other formats are decoded fully and then
+    shrunk by an integer reduce before LANCZOS resampling.
+    """
+    image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
     return image
 
 
+def variant_widths(width: int) -> list[int]:
+    """Return widths of responsive variants ending with the full width."""
+    return [variant for variant in current_app.config['IMAGE_WIDTHS']
+            if variant < width] + [width]
+
+
+def variant_name(filename: str, width: int) -> str:
+    """Return filename of a responsive variant of an image."""
+    stem, extension = os.path.splitext(filename)
+    return f'{stem}-{width}w{extension}'
+
+
+def _save_atomically(image: Image, path: str, format: str) -> None:
+    """Save image so that readers never see a half-written file."""
+    with open(f'{path}.part', 'wb') as fp:
+        image.save(fp, format, quality=100, method=3)
+    os.replace(f'{path}.part', path)
+
+
 def save_image_as_webp(
-        image: FileStorage,
+        image: FileStorage | str,
         path: str,
-        format: str = 'WEBP') -> None:
-    """Save image on SSD as WEBP format."""
+        format: str = 'WEBP',
+        widths: Sequence[int] = ()) -> None:
+    """Save image on SSD as WEBP format.
+
+    Narrower variants are saved next to it for every width but the last,
+    the full image is saved last, so it marks the whole set as ready.
+    """
     image = Image.open(image)
+    if image.mode in ('1', 'P'):
+        # these modes are resampled by the nearest neighbour only
+        image = image.convert('RGBA')
+
+    image = resize_image(image)
+
     if format == 'JPEG' and image.mode != 'RGB':
         image = image.convert('RGB')
     elif image.mode not in ('RGB', 'RGBA'):
         image = image.convert('RGBA')
 
-    image = resize_image(image)
+    for width in widths[:-1]:
+        variant = image.copy()
+        variant.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        _save_atomically(variant, variant_name(path, width), format)
+    _save_atomically(image, path, format)
+
+
+@shared_task(ignore_result=True)
+def encode_image(source: str, path: str) -> None:
+    """Encode a staged upload as WEBP and remove the original.
+
+    The original is removed even if it can not be decoded.
+    """
+    if not os.path.exists(source):
+        return
+    try:
+        with Image.open(source) as image:
+            widths = variant_widths(fit_size(*image.size)[0])
+        save_image_as_webp(source, path, widths=widths)
+        # the image may be already referred to while it was staged
+        with db.engine.begin() as connection:
+            connection.execute(update(MyImage).where(
+                MyImage.filename == os.path.basename(path)).values(
+                    widths=widths))
+    except IMAGE_ERRORS:
+        # a broken original would be served and block re-uploads forever
+        current_app.logger.exception('Staged upload %s is not encoded',
+                                     source)
+    os.remove(source)
+
+
+def find_staged_image(filename: str) -> str | None:
+    """Return path of an original upload which is not encoded yet."""
+    stem = os.path.splitext(secure_filename(filename))[0]
+    stem = re.sub(r'-\d+w$', '', stem)
+    staged = glob.glob(os.path.join(STAGING_PATH, f'{stem}.*'))
+    return staged[0] if stem and staged else None
 
-    with open(path, 'wb') as fp:
-        image.save(fp, format, quality=100, method=3)
+
+def image_widths(filename: str) -> list[int] | None:
+    """Return widths of variants of an uploaded image."""
+    path = os.path.join(FILE_BASE_PATH, filename)
+    try:
+        if os.path.exists(path):
+            with Image.open(path) as image:
+                return variant_widths(image.width)
+        staged = find_staged_image(filename)
+        if staged:
+            with Image.open(staged) as image:
+                return variant_widths(fit_size(*image.size)[0])
+    except OSError:
+        return None
+    return None
+
+
+@cache.memoize(timeout=86400)
+def _add_srcset(html: str) -> str:
+    """Return HTML with srcset attributes of uploaded images."""
+    names = get_images_names(html)
+    if not names:
+        return html
+    widths = dict(db.session.execute(
+        select(MyImage.filename, MyImage.widths).where(
+            MyImage.filename.in_(names))).all())
+
+    def add_srcset(match: re.Match) -> str:
+        filename = match.group(1)
+        image_widths = widths.get(filename) or []
+        if len(image_widths) < 2:
+            return match.group(0)
+        full_width = image_widths[-1]
+        srcset = ', '.join(
+            [*(f'/files/{variant_name(filename, width)} {width}w'
+               for width in image_widths[:-1]),
+             f'/files/{filename} {full_width}w'])
+        return match.group(0).replace(
+            '<img',
+            f'<img srcset="{srcset}" '
+            f'sizes="(max-width: {full_width}px) 100vw, {full_width}px"',
+            1)
+
+    return re.sub(r'<img[^>]*src="/files/([^"]+)"[^>]*>', add_srcset, html)
+
+
+def srcsetfilter(html: str | None) -> str | None:
+    """Let browsers choose a proper width of images in content."""
+    if not html:
+        return html
+    return _add_srcset(html)
 
 
 def is_russian_name_correct(name: str) -> bool:
@@ -114,7 +263,17 @@ def get_month_in_russian(month: str) -> str:
         case 'December': return 'Декабрь'
 
 
-def save_banned_ip_file(banned_ip: str) -> None:
-    """Write and overwrite banned IPs into JSON file."""
+def normalize_banned_ip(banned_ip: str) -> str:
+    """Return canonical form of a banned IPv4/IPv6 address or CIDR range."""
+    network = ipaddress.ip_network(banned_ip.strip(), strict=False)
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def save_banned_ip_file(banned_ip: List[str]) -> None:
+    """Write and overwrite banned IPs and CIDR ranges into JSON file."""
+    addresses = [ip for ip in banned_ip if '/' not in ip]
+    networks = [ip for ip in banned_ip if '/' in ip]
     with open(BANNED_IP_FILE_PATH, 'w') as file:
-        json.dump(banned_ip, file)
+        json.dump({'addresses': addresses, 'networks': networks}, file)
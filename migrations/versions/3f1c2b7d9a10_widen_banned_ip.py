@@ -0,0 +1,34 @@
+"""widen banned_ip for IPv6 and CIDR ranges
+
+Revision ID: 3f1c2b7d9a10
+Revises: 95305370a8c5
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2b7d9a10'
+down_revision = '95305370a8c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('banned_ips') as batch_op:
+        batch_op.alter_column(
+            'banned_ip',
+            existing_type=sa.String(length=15),
+            type_=sa.String(length=43),
+            existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('banned_ips') as batch_op:
+        batch_op.alter_column(
+            'banned_ip',
+            existing_type=sa.String(length=43),
+            type_=sa.String(length=15),
+            existing_nullable=False)
@@ -0,0 +1,30 @@
+"""add content_counters table
+
+Revision ID: 4d7e1a9b2c56
+Revises: e2a9c4b7f318
+Create Date: 2026-10-18 13:48:12.661907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d7e1a9b2c56'
+down_revision = 'e2a9c4b7f318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'content_counters',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', name=op.f('pk_content_counters'))
+    )
+    # counters are filled on the first page view or by recompute-counters
+
+
+def downgrade():
+    op.drop_table('content_counters')
@@ -0,0 +1,31 @@
+"""add full-text search index of textbook paragraphs
+
+Revision ID: 7a3f9d2e6b84
+Revises: 4d7e1a9b2c56
+Create Date: 2026-10-18 16:05:41.208374
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3f9d2e6b84'
+down_revision = '4d7e1a9b2c56'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # tsvector and GIN exist only in PostgreSQL
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(
+        "CREATE INDEX ix_textbook_paragraph_search ON textbook_paragraph "
+        "USING gin (to_tsvector('russian', content))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_textbook_paragraph_search',
+                  table_name='textbook_paragraph')
@@ -0,0 +1,109 @@
+"""move user statistics JSON into reading_progress table
+
+Revision ID: 8b4e6a1c5d27
+Revises: 3f1c2b7d9a10
+Create Date: 2026-10-18 11:03:47.815520
+
+"""
+from datetime import datetime
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4e6a1c5d27'
+down_revision = '3f1c2b7d9a10'
+branch_labels = None
+depends_on = None
+
+STATISTICS_COLUMNS = {
+    'articles_statistics': 'article',
+    'textbook_statistics': 'textbook_paragraph',
+}
+
+
+def _load_statistics(value):
+    """Decode statistics which were stored as JSON inside JSON column."""
+    while isinstance(value, str):
+        value = json.loads(value)
+    return value or {}
+
+
+def upgrade():
+    reading_progress = op.create_table(
+        'reading_progress',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('content_type', sa.String(length=20), nullable=False),
+        sa.Column('content_id', sa.Integer(), nullable=False),
+        sa.Column('read_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['user.id'],
+            name=op.f('fk_reading_progress_user_id_user'),
+            ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint(
+            'user_id', 'content_type', 'content_id',
+            name=op.f('pk_reading_progress'))
+    )
+
+    connection = op.get_bind()
+    now = datetime.now()
+    statistics = connection.execute(sa.text(
+        'SELECT user_id, articles_statistics, textbook_statistics '
+        'FROM user_statistics'))
+    rows = []
+    for statistic in statistics.mappings():
+        for column, content_type in STATISTICS_COLUMNS.items():
+            for content_id, has_read in _load_statistics(
+                    statistic[column]).items():
+                if has_read is True and content_id not in (None, 'null'):
+                    rows.append({
+                        'user_id': statistic['user_id'],
+                        'content_type': content_type,
+                        'content_id': int(content_id),
+                        'read_at': now})
+    if rows:
+        op.bulk_insert(reading_progress, rows)
+
+    op.drop_table('user_statistics')
+
+
+def downgrade():
+    user_statistics = op.create_table(
+        'user_statistics',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('articles_statistics', sa.JSON(), nullable=True),
+        sa.Column('textbook_statistics', sa.JSON(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['user.id'],
+            name=op.f('fk_user_statistics_user_id_user'),
+            ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_user_statistics'))
+    )
+
+    connection = op.get_bind()
+    content_ids = {
+        'articles_statistics': [row[0] for row in connection.execute(
+            sa.text('SELECT id FROM article'))],
+        'textbook_statistics': [row[0] for row in connection.execute(
+            sa.text('SELECT id FROM textbook_paragraph'))],
+    }
+    read = {}
+    for user_id, content_type, content_id in connection.execute(sa.text(
+            'SELECT user_id, content_type, content_id FROM reading_progress')):
+        read.setdefault((user_id, content_type), set()).add(content_id)
+
+    rows = []
+    for (user_id,) in connection.execute(sa.text('SELECT id FROM "user"')):
+        row = {'user_id': user_id}
+        for column, content_type in STATISTICS_COLUMNS.items():
+            done = read.get((user_id, content_type), set())
+            row[column] = json.dumps(
+                {id: id in done for id in content_ids[column]})
+        rows.append(row)
+    if rows:
+        op.bulk_insert(user_statistics, rows)
+
+    op.drop_table('reading_progress')
@@ -0,0 +1,27 @@
+"""add widths of responsive image variants
+
+Revision ID: b19e5c3a7f42
+Revises: 7a3f9d2e6b84
+Create Date: 2026-10-18 17:22:09.534718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b19e5c3a7f42'
+down_revision = '7a3f9d2e6b84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('widths', sa.JSON(), nullable=True))
+    # images uploaded before have no variants and keep a plain src
+
+
+def downgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.drop_column('widths')
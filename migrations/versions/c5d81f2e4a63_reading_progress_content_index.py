@@ -0,0 +1,28 @@
+"""add content index to reading_progress
+
+Revision ID: c5d81f2e4a63
+Revises: 8b4e6a1c5d27
+Create Date: 2026-10-18 11:42:05.204871
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d81f2e4a63'
+down_revision = '8b4e6a1c5d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('reading_progress', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_reading_progress_content',
+            ['content_type', 'content_id'],
+            unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('reading_progress', schema=None) as batch_op:
+        batch_op.drop_index('ix_reading_progress_content')
@@ -0,0 +1,38 @@
+"""make date of questions not null
+
+Revision ID: d3b7f1c9e5a2
+Revises: f6c2a8d41e97
+Create Date: 2026-10-18 19:26:43.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3b7f1c9e5a2'
+down_revision = 'f6c2a8d41e97'
+branch_labels = None
+depends_on = None
+
+question = sa.table('question', sa.column('date', sa.DateTime))
+
+
+def upgrade():
+    # undated questions go after all the dated ones
+    oldest = sa.select(sa.func.min(question.c.date)).scalar_subquery()
+    op.get_bind().execute(question.update().where(
+        question.c.date.is_(None)).values(
+            date=sa.func.coalesce(oldest, sa.func.now())))
+
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.alter_column('date',
+                              existing_type=sa.DateTime(),
+                              nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('question', schema=None) as batch_op:
+        batch_op.alter_column('date',
+                              existing_type=sa.DateTime(),
+                              nullable=True)
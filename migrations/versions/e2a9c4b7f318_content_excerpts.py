@@ -0,0 +1,61 @@
+"""add excerpts of large text columns
+
+Revision ID: e2a9c4b7f318
+Revises: c5d81f2e4a63
+Create Date: 2026-10-18 12:26:51.390112
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9c4b7f318'
+down_revision = 'c5d81f2e4a63'
+branch_labels = None
+depends_on = None
+
+EXCERPT_LENGTH = 150
+EXCERPT_SOURCES = {
+    'article': 'body',
+    'news': 'content',
+    'question': 'body',
+    'textbook_paragraph': 'content',
+    'user_diary': 'record',
+}
+
+
+def _make_excerpt(text):
+    """Return beginning of a text without HTML tags."""
+    if text is None:
+        return None
+    text = re.sub(r'<.*?>|&\w+;', ' ', text)
+    return ' '.join(text.split())[:EXCERPT_LENGTH]
+
+
+def upgrade():
+    connection = op.get_bind()
+    for table_name, source in EXCERPT_SOURCES.items():
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.add_column(sa.Column(
+                'excerpt', sa.String(length=EXCERPT_LENGTH), nullable=True))
+
+        table = sa.table(
+            table_name,
+            sa.column('id', sa.Integer),
+            sa.column(source, sa.UnicodeText),
+            sa.column('excerpt', sa.String))
+        rows = connection.execute(
+            sa.select(table.c.id, table.c[source])).all()
+        for row_id, text in rows:
+            connection.execute(
+                table.update().where(table.c.id == row_id).values(
+                    excerpt=_make_excerpt(text)))
+
+
+def downgrade():
+    for table_name in EXCERPT_SOURCES:
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.drop_column('excerpt')
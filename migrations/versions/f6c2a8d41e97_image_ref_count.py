@@ -0,0 +1,86 @@
+"""count references of images and make filenames unique
+
+Revision ID: f6c2a8d41e97
+Revises: b19e5c3a7f42
+Create Date: 2026-10-18 18:41:27.903215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6c2a8d41e97'
+down_revision = 'b19e5c3a7f42'
+branch_labels = None
+depends_on = None
+
+image = sa.table('image', sa.column('id', sa.Integer),
+                 sa.column('filename', sa.String),
+                 sa.column('ref_count', sa.Integer))
+# tables referring to images, the first column is the other side
+# of an association or None for a plain foreign key
+references = {
+    'news': None,
+    'article_card': None,
+    'article_image': 'article_id',
+    'textbook_paragraph_image': 'textbook_paragraph_id',
+}
+
+
+def upgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.add_column(sa.Column(
+            'ref_count', sa.Integer(), server_default='0', nullable=False))
+
+    connection = op.get_bind()
+
+    # merge rows of the same file into the row with the lowest id
+    keep = {}
+    duplicates = {}
+    for image_id, filename in connection.execute(
+            sa.select(image.c.id, image.c.filename).order_by(image.c.id)):
+        if filename in keep:
+            duplicates[image_id] = keep[filename]
+        else:
+            keep[filename] = image_id
+
+    for table_name, owner in references.items():
+        table = sa.table(table_name, sa.column('image_id', sa.Integer),
+                         *([sa.column(owner, sa.Integer)] if owner else []))
+        if owner is None:
+            for old_id, new_id in duplicates.items():
+                connection.execute(table.update().where(
+                    table.c.image_id == old_id).values(image_id=new_id))
+            continue
+        rows = connection.execute(sa.select(
+            table.c[owner], table.c.image_id)).all()
+        pairs = {(owner_id, duplicates.get(image_id, image_id))
+                 for owner_id, image_id in rows}
+        connection.execute(table.delete())
+        if pairs:
+            connection.execute(table.insert(), [
+                {owner: owner_id, 'image_id': image_id}
+                for owner_id, image_id in sorted(pairs)])
+
+    if duplicates:
+        connection.execute(image.delete().where(
+            image.c.id.in_(list(duplicates))))
+
+    ref_count = sa.literal(0)
+    for table_name in references:
+        table = sa.table(table_name, sa.column('image_id', sa.Integer))
+        ref_count = ref_count + sa.select(sa.func.count()).select_from(
+            table).where(table.c.image_id == image.c.id).scalar_subquery()
+    connection.execute(image.update().values(ref_count=ref_count))
+
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.create_unique_constraint(
+            batch_op.f('uq_image_filename'), ['filename'])
+
+
+def downgrade():
+    with op.batch_alter_table('image', schema=None) as batch_op:
+        batch_op.drop_constraint(
+            batch_op.f('uq_image_filename'), type_='unique')
+        batch_op.drop_column('ref_count')
@@ -1,7 +1,9 @@
+from contextlib import contextmanager
 import os
 
 import pytest
 from mimesis import Generic, Locale
+from sqlalchemy import event
 
 
 from mct_app import create_app, db
@@ -120,6 +122,32 @@ class AuthActions:
         return self._client.get('/logout')
 
 
+class QueryCounter:
+    """Class to count SQL queries sent to the database."""
+
+    def __init__(self):
+        """Initialize an empty list of statements."""
+        self.statements = []
+
+    @property
+    def count(self):
+        """Return amount of sent queries."""
+        return len(self.statements)
+
+    def _add_statement(self, conn, cursor, statement, *args):
+        """Remember a statement before sending it."""
+        self.statements.append(statement)
+
+    def __enter__(self):
+        """Start counting queries of the current engine."""
+        event.listen(db.engine, 'before_cursor_execute', self._add_statement)
+        return self
+
+    def __exit__(self, *args):
+        """Stop counting queries."""
+        event.remove(db.engine, 'before_cursor_execute', self._add_statement)
+
+
 class AdminActions:
     """Class to create admin and his actions."""
 
@@ -152,3 +180,22 @@ def admin(client):
 def auth(client):
     """Create authenticated user fixture."""
     return AuthActions(client)
+
+
+@pytest.fixture
+def count_queries(app):
+    """Create fixture counting SQL queries inside a with block."""
+    return QueryCounter
+
+
+@pytest.fixture
+def query_budget(app):
+    """Create fixture failing when a block sends too many SQL queries."""
+    @contextmanager
+    def check_budget(budget):
+        with app.app_context(), QueryCounter() as counter:
+            yield counter
+        assert counter.count <= budget, \
+            f'Выполнено {counter.count} SQL-запросов при лимите {budget}:\n' \
+            + '\n'.join(counter.statements)
+    return check_budget
@@ -1,7 +1,12 @@
+import hashlib
 from http import HTTPStatus
+from io import BytesIO
+import os
 
+from config import FILE_BASE_PATH
 from mct_app.auth.models import User
 from mct_app.site.models import TextbookChapter
+from mct_app.utils import find_staged_image
 from tests.conftest import generic, sentence, title
 
 new_title = generic.text.quote()
@@ -127,3 +132,39 @@ def test_anon_hasnt_access_to_admin_panel(app, client):
     with app.app_context():
         assert final_response.status_code == HTTPStatus.FORBIDDEN, \
             'Аноним вошел в админку'
+
+
+def test_uploaded_files_are_cached_forever(client):
+    """Test uploaded files support long caching and ranges."""
+    filename = f'{generic.cryptographic.token_hex()}.webp'
+    path = os.path.join(FILE_BASE_PATH, filename)
+    os.makedirs(FILE_BASE_PATH, exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(b'webp' * 100)
+
+    response = client.get(f'/files/{filename}')
+    assert 'immutable' in response.headers['Cache-Control'], \
+        'Загруженный файл не кэшируется навсегда'
+    assert response.headers['ETag'] == f'"{filename[:-5]}"', \
+        'Неверный ETag загруженного файла'
+    response = client.get(f'/files/{filename}',
+                          headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED, \
+        'Не проверен ETag загруженного файла'
+    response = client.get(f'/files/{filename}',
+                          headers={'Range': 'bytes=0-3'})
+    assert (response.status_code, response.data) == \
+        (HTTPStatus.PARTIAL_CONTENT, b'webp'), \
+        'Не поддерживаются запросы части файла'
+    os.remove(path)
+
+
+def test_broken_upload_is_not_staged(client):
+    """Test an upload which is not an image is refused."""
+    data = b'not an image'
+    response = client.post('/upload', data={
+        'upload': (BytesIO(data), 'broken.jpg')})
+    assert 'error' in response.get_json(), \
+        'Поврежденное изображение не отклонено'
+    assert find_staged_image(f'{hashlib.sha256(data).hexdigest()}.webp') \
+        is None, 'Поврежденное изображение сохранено'
@@ -1,11 +1,15 @@
 from http import HTTPStatus
 
 import pytest
+from sqlalchemy import select
 
 
 from tests.conftest import email, generic, password, username
 
-from mct_app.auth.models import User
+from config import ContentType
+from mct_app import db
+from mct_app.auth.models import (load_user, ReadingProgress,
+                                 User, UserPrincipal)
 
 expected_title = '<title>Метакогнитивная терапия -'
 ' новости, статьи, учебник, консультации</title>'
@@ -190,6 +194,91 @@ def test_auth_user_has_statistics_access(app, auth, client):
             'Пользователь не получил доступ к статистике'
 
 
+def test_load_user_uses_single_query(app, count_queries):
+    """Test current user and his role are loaded in one query."""
+    with app.app_context():
+        user_id = db.session.scalar(
+            select(User.id).filter_by(username='admin'))
+        db.session.expunge_all()
+        with count_queries() as counter:
+            user = load_user(str(user_id))
+            user.is_admin()
+            user.username
+        assert counter.count == 1, \
+            f'Загрузка пользователя выполнила {counter.count} запросов'
+
+
+def test_role_is_resolved_once(app, count_queries):
+    """Test permission checks do not query roles repeatedly."""
+    with app.app_context():
+        user = db.session.scalar(select(User).filter_by(username='admin'))
+        with count_queries() as counter:
+            for _ in range(3):
+                user.is_admin()
+                user.is_doctor()
+        assert counter.count <= 1, \
+            f'Проверка роли выполнила {counter.count} запросов'
+        user.reset_role()
+        assert user.is_admin(), 'Роль админа не восстановилась после сброса'
+
+
+def test_principal_cache_skips_database(app, count_queries):
+    """Test cached principal is loaded without queries until forgotten."""
+    with app.app_context():
+        user = db.session.scalar(select(User).filter_by(username='admin'))
+        app.config['PRINCIPAL_CACHE'] = True
+        try:
+            UserPrincipal.forget(user.id)
+            load_user(str(user.id))
+            with count_queries() as counter:
+                principal = load_user(str(user.id))
+                assert principal.is_admin(), 'Снимок потерял роль админа'
+            assert counter.count == 0, \
+                'Закэшированный пользователь загружался из базы данных'
+            assert principal.email == user.email, \
+                'Снимок не получил недостающий атрибут из базы данных'
+
+            UserPrincipal.forget(user.id)
+            with count_queries() as counter:
+                load_user(str(user.id))
+            assert counter.count == 1, \
+                'Сброшенный снимок не загрузился из базы данных'
+        finally:
+            app.config['PRINCIPAL_CACHE'] = False
+
+
+def test_reading_progress_toggle(app):
+    """Test marking content as read and unread."""
+    with app.app_context():
+        user = db.session.scalar(select(User).filter_by(username='admin'))
+        assert ReadingProgress.toggle(
+            user.id, ContentType.ARTICLE, 1) is True, \
+            'Статья не была отмечена прочитанной'
+        assert ReadingProgress.has_read(user.id, ContentType.ARTICLE, 1), \
+            'Прочитанная статья не найдена'
+        assert ReadingProgress.read_ids(
+            user.id, ContentType.TEXTBOOK_PARAGRAPH) == set(), \
+            'Статья попала в прочитанные параграфы учебника'
+        assert ReadingProgress.toggle(
+            user.id, ContentType.ARTICLE, 1) is False, \
+            'Статья не была отмечена непрочитанной'
+        assert not ReadingProgress.read_ids(user.id, ContentType.ARTICLE), \
+            'Отметка о прочтении статьи не удалилась'
+
+
+def test_reading_progress_forget(app):
+    """Test marks of deleted content are removed for all users."""
+    with app.app_context():
+        ReadingProgress.toggle(1, ContentType.TEXTBOOK_PARAGRAPH, 101)
+        ReadingProgress.toggle(1, ContentType.TEXTBOOK_PARAGRAPH, 102)
+        ReadingProgress.forget(ContentType.TEXTBOOK_PARAGRAPH, 101)
+        db.session.commit()
+        assert ReadingProgress.read_ids(
+            1, ContentType.TEXTBOOK_PARAGRAPH) == {102}, \
+            'Неверно удалены отметки об удаленном параграфе'
+        ReadingProgress.toggle(1, ContentType.TEXTBOOK_PARAGRAPH, 102)
+
+
 def test_auth_user_has_diary_access(app, client):
     """Test registered user has his own diary."""
     response = client.get(f'/profile/{username}/diary')
@@ -0,0 +1,120 @@
+import ipaddress
+import json
+import os
+import time
+
+from flask import Flask
+import pytest
+
+from mct_app.blacklist import IPBlacklist, RadixTree
+
+
+def _make_blacklist(path, entries):
+    """Write banned IPs file and return a blacklist reading it."""
+    with open(path, 'w') as file:
+        json.dump(entries, file)
+    flask_app = Flask(__name__)
+    flask_app.config.update(
+        BANNED_IP_PATH=str(path),
+        BANNED_IP_CHECK_INTERVAL=0)
+    return IPBlacklist(flask_app)
+
+
+@pytest.mark.parametrize(('ip', 'output'), (
+                        ('192.168.1.10', True),
+                        ('192.168.1.11', False),
+                        ('172.16.5.4', True),
+                        ('172.32.0.1', False),
+                        ('2001:db8::1', True),
+                        ('not-an-ip', False),
+                        (None, False)))
+def test_blacklist_is_banned(tmp_path, ip, output):
+    """Test matching of single IPs and CIDR ranges."""
+    blacklist = _make_blacklist(
+        tmp_path / 'banned_ip.json',
+        ['192.168.1.10', '172.16.0.0/12', '2001:db8::/32'])
+    assert blacklist.is_banned(ip) is output, \
+        f'Неверная проверка IP {ip} по черному списку'
+
+
+def test_blacklist_reads_addresses_and_networks(tmp_path):
+    """Test the file format with separate addresses and networks."""
+    blacklist = _make_blacklist(
+        tmp_path / 'banned_ip.json',
+        {'addresses': ['10.0.0.1', '2001:db8::5'],
+         'networks': ['192.168.0.0/16', 'fe80::/10']})
+    assert blacklist.is_banned('10.0.0.1'), 'IPv4 адрес не забанен'
+    assert blacklist.is_banned('2001:db8::5'), 'IPv6 адрес не забанен'
+    assert blacklist.is_banned('192.168.200.1'), 'IPv4 диапазон не забанен'
+    assert blacklist.is_banned('fe80::1:2'), 'IPv6 диапазон не забанен'
+    assert not blacklist.is_banned('10.0.0.2'), 'Лишний IP забанен'
+
+
+@pytest.mark.parametrize(('address', 'output'), (
+                        ('10.1.2.3', True),
+                        ('10.2.0.1', True),
+                        ('11.0.0.1', False),
+                        ('192.168.1.1', True),
+                        ('192.168.1.2', False),
+                        ('192.168.2.255', True),
+                        ('192.168.3.0', False),
+                        ('2001:db8:ffff::1', True),
+                        ('2001:db9::1', False)))
+def test_radix_tree_contains(address, output):
+    """Test lookup in radix tree with nested and sibling networks."""
+    tree = RadixTree()
+    for network in ('10.1.0.0/16', '10.0.0.0/8', '192.168.1.1/32',
+                    '192.168.2.0/24', '10.1.2.0/24', '2001:db8::/32'):
+        tree.insert(ipaddress.ip_network(network))
+    assert (ipaddress.ip_address(address) in tree) is output, \
+        f'Неверный поиск {address} в radix-дереве'
+
+
+def test_blacklist_reloads_changed_file(tmp_path):
+    """Test blacklist is reloaded after the file was rewritten."""
+    path = tmp_path / 'banned_ip.json'
+    blacklist = _make_blacklist(path, ['192.168.1.10'])
+    assert blacklist.is_banned('192.168.1.10'), 'IP не был забанен'
+
+    with open(path, 'w') as file:
+        json.dump(['192.168.1.20', '192.168.1.30'], file)
+    assert not blacklist.is_banned('192.168.1.10'), \
+        'Черный список не обновился после изменения файла'
+    assert blacklist.is_banned('192.168.1.20'), \
+        'Новый IP не попал в черный список'
+
+    os.remove(path)
+    assert not blacklist.is_banned('192.168.1.20'), \
+        'Черный список не очистился после удаления файла'
+
+
+def test_blacklist_is_not_reread_within_interval(tmp_path, monkeypatch):
+    """Test requests are checked in memory between file checks."""
+    path = tmp_path / 'banned_ip.json'
+    blacklist = _make_blacklist(path, ['192.168.1.10'])
+    blacklist._check_interval = 1
+    now = 100.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    assert blacklist.is_banned('192.168.1.10'), 'IP не был забанен'
+
+    reads = []
+    stat = os.stat
+
+    def counted_stat(*args, **kwargs):
+        reads.append('stat')
+        return stat(*args, **kwargs)
+
+    def counted_open(*args, **kwargs):
+        reads.append('open')
+        return open(*args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', counted_stat)
+    monkeypatch.setattr('mct_app.blacklist.open', counted_open, raising=False)
+    for ip in ('192.168.1.10', '192.168.1.11') * 50:
+        blacklist.is_banned(ip)
+    assert reads == [], 'Файл черного списка читается на каждом запросе'
+
+    now += 1
+    assert blacklist.is_banned('192.168.1.10'), 'IP пропал из черного списка'
+    assert reads == ['stat'], \
+        'Неизменный файл черного списка прочитан заново'
@@ -0,0 +1,50 @@
+from flask_login import login_user, logout_user
+
+from mct_app import db
+from mct_app.auth.models import User
+from mct_app.caching import (ANONYMOUS_NAMESPACE, invalidate_tags,
+                             invalidate_user_namespace, tagged_cache_key,
+                             user_cache_key, user_namespace)
+
+
+def test_anonymous_namespace(app):
+    """Test anonymous visitors share the same cache namespace."""
+    with app.test_request_context('/contacts'):
+        assert user_namespace() == ANONYMOUS_NAMESPACE, \
+            'Аноним получил персональное пространство кэша'
+        assert user_cache_key().endswith('/contacts'), \
+            'Ключ кэша не содержит адрес страницы'
+
+
+def test_user_namespace_invalidation(app):
+    """Test invalidation changes namespace of only one user."""
+    with app.test_request_context('/contacts'):
+        user = db.session.get(User, 1)
+        login_user(user)
+        before = user_namespace()
+        invalidate_user_namespace(user.id + 1)
+        assert user_namespace() == before, \
+            'Сброс кэша другого пользователя затронул текущего'
+        invalidate_user_namespace(user.id)
+        assert user_namespace() != before, \
+            'Сброс кэша пользователя не изменил его пространство'
+        logout_user()
+
+
+def test_tagged_cache_key_invalidation(app):
+    """Test bumping a tag changes keys of only depending pages."""
+    textbook_key = tagged_cache_key('textbook')
+    articles_key = tagged_cache_key('articles', key='articles_list')
+    with app.test_request_context('/textbook'):
+        textbook_before = textbook_key()
+        articles_before = articles_key()
+        invalidate_tags('news')
+        assert textbook_key() == textbook_before, \
+            'Изменение новостей сбросило кэш учебника'
+        assert articles_key() == articles_before, \
+            'Изменение новостей сбросило кэш статей'
+        invalidate_tags('textbook')
+        assert textbook_key() != textbook_before, \
+            'Изменение учебника не сбросило кэш учебника'
+        assert articles_key() == articles_before, \
+            'Изменение учебника сбросило кэш статей'
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, inspect, select
+
+from mct_app import db
+from mct_app.auth.models import UserDiary
+from mct_app.pagination import _serializer, keyset_paginate, load_cursor
+from mct_app.site.models import ContentCounter
+from tests.conftest import sentence
+
+PER_PAGE = 3
+
+
+def _paginate(app, query_string=''):
+    """Return a page of diary records of the admin."""
+    with app.test_request_context(f'/?{query_string}'):
+        return keyset_paginate(
+            select(UserDiary).filter_by(user_id=1),
+            UserDiary.date, UserDiary.id, PER_PAGE, 'diary/1')
+
+
+def test_keyset_pagination_walks_both_ways(app):
+    """Test cursors lead to the same pages as offsets."""
+    with app.app_context():
+        date = datetime(2024, 1, 1)
+        records = [
+            UserDiary(date=date + timedelta(days=i // 2), mood='HAPPY',
+                      record=sentence, user_id=1) for i in range(8)]
+        db.session.add_all(records)
+        db.session.commit()
+        expected = db.session.scalars(
+            select(UserDiary.id).filter_by(user_id=1).order_by(
+                UserDiary.date.desc(), UserDiary.id.desc())).all()
+
+        first = _paginate(app)
+        second = _paginate(app, f'cursor={first.next_cursor}')
+        third = _paginate(app, f'cursor={second.next_cursor}')
+        back = _paginate(app, f'cursor={third.prev_cursor}')
+
+        pages = (first, second, third)
+        assert [item.id for page in pages for item in page.items] \
+            == expected, \
+            'Страницы по курсору не совпадают с сортировкой'
+        assert not third.has_next, 'После последней страницы есть курсор'
+        assert [item.id for item in back.items] == \
+            [item.id for item in second.items], \
+            'Курсор назад вернул другую страницу'
+        assert (back.page, back.pages) == (2, 3), \
+            'Неверный номер страницы или количество страниц'
+        assert [item.id for item in _paginate(app, 'page=2').items] == \
+            [item.id for item in second.items], \
+            'Переход по номеру страницы не совпадает с курсором'
+
+        for record in records:
+            db.session.delete(record)
+        db.session.commit()
+
+
+def test_content_counter_follows_inserts_and_deletes(app):
+    """Test counter is maintained by events and can be recomputed."""
+    with app.app_context():
+        before = ContentCounter.get(
+            'diary/1', select(UserDiary).filter_by(user_id=1))
+        record = UserDiary(date=datetime.now(), mood='HAPPY',
+                           record=sentence, user_id=1)
+        db.session.add(record)
+        db.session.commit()
+        assert db.session.get(ContentCounter, 'diary/1').value == \
+            before + 1, 'Счетчик не увеличился после добавления записи'
+
+        db.session.delete(record)
+        db.session.commit()
+        db.session.expire_all()
+        assert db.session.get(ContentCounter, 'diary/1').value == before, \
+            'Счетчик не уменьшился после удаления записи'
+        assert ContentCounter.recompute().get('diary/1', 0) == before, \
+            'Пересчет счетчика не совпал с поддерживаемым значением'
+
+
+def test_missing_counter_keeps_session(app):
+    """Test creating a missing counter does not commit the request."""
+    with app.app_context():
+        record = UserDiary(date=datetime.now(), mood='HAPPY',
+                           record=sentence, user_id=1)
+        db.session.add(record)
+        db.session.commit()
+        db.session.execute(
+            delete(ContentCounter).where(ContentCounter.name == 'diary/1'))
+        db.session.commit()
+
+        with app.test_request_context('/'):
+            page = keyset_paginate(
+                select(UserDiary).filter_by(user_id=1),
+                UserDiary.date, UserDiary.id, PER_PAGE, 'diary/1')
+            assert not any(inspect(item).expired for item in page.items), \
+                'Создание счетчика сбросило загруженные записи'
+        assert db.session.get(ContentCounter, 'diary/1').value \
+            == page.total, 'Отсутствующий счетчик не создан'
+
+        db.session.delete(record)
+        db.session.commit()
+
+
+@pytest.mark.parametrize('cursor', ([2, 'next', None, 5],
+                                    [2, 'down', '2024-01-01T00:00:00', 5],
+                                    [2, 'next', 'yesterday', 5],
+                                    'next'))
+def test_malformed_cursor_is_rejected(app, cursor):
+    """Test a cursor without a proper sort key falls back to no cursor."""
+    with app.test_request_context('/'):
+        assert load_cursor(_serializer().dumps(cursor)) is None, \
+            'Принят курсор с неверным ключом сортировки'
@@ -1,6 +1,16 @@
+from datetime import datetime
 from http import HTTPStatus
+import os
 
-from tests.conftest import generic
+import pytest
+
+from config import EXCERPT_LENGTH, FILE_BASE_PATH
+from mct_app import db
+from mct_app.auth.models import Answer, Question
+from mct_app.search import _bulk_actions, _snippet, normalize_query
+from mct_app.site.models import (ExcerptMixin, Image, TextbookParagraph,
+                                 TextbookParagraphImage)
+from tests.conftest import generic, sentence
 from tests.test_auth import expected_title
 
 first_name = generic.person.first_name()
@@ -30,3 +40,146 @@ def test_unexisted_page_access(app, client):
     with app.app_context():
         assert response.status_code == HTTPStatus.NOT_FOUND, \
             f'Отстствует ошибка 404 для {random_url}'
+
+
+def test_unexisted_textbook_paragraph(app, client):
+    """Test 404 error for a paragraph missing in the navigation index."""
+    response = client.get(f'/textbook/{generic.text.word()}-missing')
+
+    with app.app_context():
+        assert response.status_code == HTTPStatus.NOT_FOUND, \
+            'Отсутствует ошибка 404 для несуществующего параграфа'
+
+
+@pytest.mark.parametrize(('text', 'output'), (
+                        ('<p>Первый&nbsp;<b>абзац</b></p>\n<p>Второй</p>',
+                         'Первый абзац Второй'),
+                        ('а' * (EXCERPT_LENGTH + 10), 'а' * EXCERPT_LENGTH),
+                        (None, None)))
+def test_make_excerpt(text, output):
+    """Test excerpt is a short text without HTML tags."""
+    assert ExcerptMixin.make_excerpt(text) == output, \
+        'Неверно сформирован отрывок текста'
+
+
+def test_questions_query_budget(app, client, query_budget):
+    """Test question pages send a constant amount of SQL queries."""
+    with app.app_context():
+        question = Question(anon_name=first_name, body=sentence,
+                            date=datetime.now(), ip_address='127.0.0.1')
+        question.answers = [Answer(body=sentence) for _ in range(5)]
+        db.session.add(question)
+        db.session.commit()
+        question_id = question.id
+
+    with query_budget(4):
+        response = client.get('/questions')
+    assert response.status_code == HTTPStatus.OK, \
+        'Список вопросов недоступен'
+
+    with query_budget(4):
+        response = client.get(f'/questions/{question_id}')
+    assert response.status_code == HTTPStatus.OK, \
+        'Страница вопроса недоступна'
+
+
+def test_bulk_actions_follow_database(app):
+    """Test queued documents are indexed if they exist, else deleted."""
+    with app.app_context():
+        paragraph = TextbookParagraph(name=first_name, content=sentence)
+        db.session.add(paragraph)
+        db.session.commit()
+        actions = _bulk_actions([f'textbook_paragraph:{paragraph.id}',
+                                 'textbook_paragraph:0'])
+        assert {(action['_op_type'], action['_id']) for action in actions} \
+            == {('index', paragraph.id), ('delete', 0)}, \
+            'Неверно сформированы операции для Elasticsearch'
+        db.session.delete(paragraph)
+        db.session.commit()
+
+
+def test_flushed_changes_are_indexed(app, monkeypatch):
+    """Test changes flushed before commit are queued for indexing."""
+    queued = []
+    monkeypatch.setattr('mct_app.site.models.queue_index',
+                        lambda changes: queued.extend(changes))
+    with app.app_context():
+        paragraph = TextbookParagraph(name=first_name, content=sentence)
+        db.session.add(paragraph)
+        db.session.commit()
+        paragraph.content = f'{sentence} {sentence}'
+        db.session.flush()
+        db.session.commit()
+        paragraph_id = paragraph.id
+        assert queued == [('textbook_paragraph', paragraph_id)] * 2, \
+            'Измененный параграф не поставлен в очередь индексации'
+        db.session.delete(paragraph)
+        db.session.commit()
+
+
+def test_search_snippet_is_safe():
+    """Test search snippets keep highlights and drop source markup."""
+    assert _snippet('ass="x">Текст <b>\x02учебника\x03</b> <script>') == \
+        'Текст <mark>учебника</mark>', \
+        'Неверно сформирован фрагмент результата поиска'
+
+
+@pytest.mark.parametrize(('first', 'second'), (
+                        ('Тревога', '  тревоги '),
+                        ('руминация', 'РУМИНАЦИЕЙ'),
+                        ('панические атаки', 'Панической атаке?')))
+def test_normalize_query(first, second):
+    """Test word forms of a query share one cache key."""
+    assert normalize_query(first) == normalize_query(second), \
+        'Формы слов запроса нормализованы по-разному'
+
+
+def test_search_falls_back_to_database(app, client):
+    """Test search works without Elasticsearch."""
+    word = f'{generic.text.word()}поиск'
+    with app.app_context():
+        paragraph = TextbookParagraph(name=first_name,
+                                      content=f'{sentence} {word}')
+        db.session.add(paragraph)
+        db.session.commit()
+        paragraph_id = paragraph.id
+
+    response = client.get(f'/search?q={word}')
+    assert response.status_code == HTTPStatus.OK, \
+        'Поиск недоступен без Elasticsearch'
+    assert first_name in response.get_data(as_text=True), \
+        'Параграф не найден поиском по базе данных'
+
+    with app.app_context():
+        db.session.delete(db.session.get(TextbookParagraph, paragraph_id))
+        db.session.commit()
+
+
+def test_shared_image_is_removed_with_last_reference(app):
+    """Test an image file is kept until nobody refers to it."""
+    filename = f'{generic.cryptographic.token_hex()}.webp'
+    path = os.path.join(FILE_BASE_PATH, filename)
+    os.makedirs(FILE_BASE_PATH, exist_ok=True)
+    open(path, 'wb').close()
+    with app.app_context():
+        paragraphs = [TextbookParagraph(name=first_name, content=sentence)
+                      for _ in range(2)]
+        for paragraph in paragraphs:
+            paragraph.images.append(TextbookParagraphImage(
+                image=Image.for_file(filename)))
+        db.session.add_all(paragraphs)
+        db.session.commit()
+        image = db.session.scalar(
+            db.select(Image).where(Image.filename == filename))
+        assert image.ref_count == 2, 'Неверно посчитаны ссылки на картинку'
+        image_id = image.id
+
+        db.session.delete(paragraphs[0])
+        db.session.commit()
+        assert os.path.exists(path), 'Удалена картинка, на которую есть ссылка'
+
+        db.session.delete(paragraphs[1])
+        db.session.commit()
+        assert db.session.get(Image, image_id) is None, \
+            'Не удалена картинка без ссылок'
+    assert not os.path.exists(path), 'Не удален файл картинки без ссылок'
@@ -1,10 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+
+from PIL import Image
 import pytest
 
-from mct_app.utils import (generate_image_name, get_images_names,
-                           get_random_email, get_statistics_data,
-                           is_russian_name_correct)
+from mct_app import db
+from mct_app.site.models import Image as MyImage
+from mct_app.utils import (encode_image, generate_image_name,
+                           get_images_names, get_random_email,
+                           get_statistics_data, is_russian_name_correct,
+                           mark_read_paragraphs, normalize_banned_ip,
+                           srcsetfilter)
+from tests.conftest import generic
 from tests.test_site import first_name, last_name, phone
 
+BENCHMARK_SIZE = (6000, 4000)
+BENCHMARK_SCRIPT = """
+import json, sys
+from PIL import Image
+from mct_app.utils import resize_image
+
+
+def full_decode(path):
+    return Image.open(path).convert('RGB').resize((1080, 720))
+
+
+def reduced_decode(path):
+    return resize_image(Image.open(path))
+
+
+def peak_rss():
+    # ru_maxrss is inherited from the parent, VmHWM can be reset
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+with open('/proc/self/clear_refs', 'w') as clear_refs:
+    clear_refs.write('5')
+image = globals()[sys.argv[1]](sys.argv[2])
+print(json.dumps({'size': image.size, 'rss': peak_rss()}))
+"""
+
 _test_html = """
 <!DOCTYPE html>
 <html lang="en">
@@ -65,3 +105,118 @@ def test_is_russian_name_correct(name, output):
     """Test correctness of Russian name."""
     result = is_russian_name_correct(name)
     assert result == output, f'Неверная валидация русского имени для {name}'
+
+
+@pytest.mark.parametrize(('banned_ip', 'output'), (
+                        ('192.168.1.10', '192.168.1.10'),
+                        (' 192.168.1.10/32 ', '192.168.1.10'),
+                        ('192.168.1.10/24', '192.168.1.0/24'),
+                        ('2001:DB8::1', '2001:db8::1'),
+                        ('2001:db8::1/32', '2001:db8::/32')))
+def test_normalize_banned_ip(banned_ip, output):
+    """Test normalization of banned IPs and CIDR ranges."""
+    result = normalize_banned_ip(banned_ip)
+    assert result == output, f'Неверная нормализация IP {banned_ip}'
+
+
+@pytest.mark.parametrize('banned_ip', ('', '256.1.1.1', '10.0.0.0/33', 'ip'))
+def test_normalize_wrong_banned_ip(banned_ip):
+    """Test wrong banned IPs are rejected."""
+    with pytest.raises(ValueError):
+        normalize_banned_ip(banned_ip)
+
+
+def test_mark_read_paragraphs():
+    """Test putting check marks only before read paragraphs."""
+    tree = '<a><!--read:1-->Первая</a><a><!--read:12-->Вторая</a>'
+    result = mark_read_paragraphs(tree, {12})
+    assert result == '<a>Первая</a><a>✅ Вторая</a>', \
+        'Неверно отмечены изученные параграфы учебника'
+
+
+def test_encode_staged_image(app, tmp_path):
+    """Test a staged upload is encoded as small WEBP and removed."""
+    source = tmp_path / 'upload.jpg'
+    path = tmp_path / 'upload.webp'
+    Image.new('RGB', (2560, 1440), 'red').save(source)
+    with app.app_context():
+        encode_image(str(source), str(path))
+    assert not source.exists(), 'Оригинал загрузки не удален'
+    with Image.open(path) as image:
+        assert (image.format, image.size) == ('WEBP', (1280, 720)), \
+            'Неверно закодировано загруженное изображение'
+    for width in (320, 640):
+        with Image.open(tmp_path / f'upload-{width}w.webp') as image:
+            assert image.width == width, \
+                f'Неверная ширина варианта изображения {width}'
+
+
+def test_encode_image_records_widths(app, tmp_path):
+    """Test encoding stores widths of an image referred to while staged."""
+    filename = f'{generic.cryptographic.token_hex()}.webp'
+    source = tmp_path / 'staged.png'
+    Image.new('RGB', (800, 600), 'red').save(source)
+    with app.app_context():
+        image = MyImage.for_file(filename)
+        db.session.commit()
+        encode_image(str(source), str(tmp_path / filename))
+        db.session.refresh(image)
+        assert image.widths == [320, 640, 800], \
+            'Не сохранены ширины вариантов изображения'
+        db.session.delete(image)
+        db.session.commit()
+
+
+def test_encode_broken_upload(app, tmp_path):
+    """Test a staged upload which is not an image is removed."""
+    source = tmp_path / 'broken.jpg'
+    path = tmp_path / 'broken.webp'
+    source.write_bytes(b'not an image')
+    with app.app_context():
+        encode_image(str(source), str(path))
+    assert not source.exists(), 'Поврежденная загрузка не удалена'
+    assert not path.exists(), 'Поврежденная загрузка закодирована'
+
+
+def test_srcsetfilter(app):
+    """Test uploaded images in content get srcset of their variants."""
+    with app.app_context():
+        image = MyImage(filename='srcset.webp', absolute_path='',
+                        relative_path='', widths=[320, 1000])
+        db.session.add(image)
+        db.session.commit()
+        result = srcsetfilter('<p><img src="/files/srcset.webp"></p>'
+                              '<img src="/files/unknown.webp">')
+        db.session.delete(image)
+        db.session.commit()
+    assert result == (
+        '<p><img srcset="/files/srcset-320w.webp 320w, '
+        '/files/srcset.webp 1000w" sizes="(max-width: 1000px) 100vw, '
+        '1000px" src="/files/srcset.webp"></p>'
+        '<img src="/files/unknown.webp">'), \
+        'Неверно сформирован srcset изображений'
+
+
+def _measure_decoding(function, path):
+    """Return decoded size and peak RSS of decoding in a fresh process."""
+    result = subprocess.run(
+        [sys.executable, '-c', BENCHMARK_SCRIPT, function, str(path)],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='peak memory is read from /proc')
+def test_resize_image_memory(tmp_path):
+    """Compare memory of full and reduced decoding of a large JPEG."""
+    path = tmp_path / 'large.jpg'
+    Image.radial_gradient('L').resize(BENCHMARK_SIZE).convert('RGB').save(
+        path, quality=90)
+    full = _measure_decoding('full_decode', path)
+    reduced = _measure_decoding('reduced_decode', path)
+
+    assert reduced['size'] == full['size'] == [1080, 720], \
+        'Неверный размер уменьшенного изображения'
+    assert reduced['rss'] < full['rss'], \
+        'Уменьшенное декодирование расходует не меньше памяти'